@@ -1,8 +1,12 @@
 import argparse
 import base64 as b64
+import struct
+import sys
 from io import BytesIO
 from pickle import UnpicklingError
 
+import numpy as np
+
 # noinspection PyUnresolvedReferences
 from inference.inference_config import *
 from inference.inference_utils import fit_model, apply_model
@@ -31,6 +35,36 @@ def unpickle_tensor(s_data: str):
         print(e)
 
 
+# Binary protocol: little-endian header (magic, n_queries, n_columns), then one record per query.
+# Dense record: float32[n_columns] probabilities.
+# Top-k record: int32[n_columns] class indices followed by float32[n_columns] probabilities.
+DENSE_MAGIC = b'FSLD'
+TOP_K_MAGIC = b'FSLK'
+BINARY_HEADER = '<4sII'
+BINARY_CHUNK_ROWS = 1024
+
+
+def write_binary_prediction(prediction, stream):
+    if isinstance(prediction, tuple):
+        prob, classes = prediction
+        classes = classes.reshape(-1, classes.size(-1)).to(torch.int32).cpu().numpy()
+        magic = TOP_K_MAGIC
+    else:
+        prob, classes = prediction, None
+        magic = DENSE_MAGIC
+    prob = prob.reshape(-1, prob.size(-1)).to(torch.float32).cpu().numpy()
+
+    stream.write(struct.pack(BINARY_HEADER, magic, prob.shape[0], prob.shape[1]))
+    for begin in range(0, prob.shape[0], BINARY_CHUNK_ROWS):
+        end = begin + BINARY_CHUNK_ROWS
+        if classes is None:
+            stream.write(prob[begin:end].tobytes())
+        else:
+            # int32 and float32 have the same width, so a row of both is one contiguous record
+            stream.write(np.concatenate([classes[begin:end].view(np.float32), prob[begin:end]], axis=1).tobytes())
+        stream.flush()
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Apply model.')
 
@@ -46,6 +80,10 @@ def parse_args():
     query_group.add_argument('--query_pickle0', type=unpickle_tensor,
                              help='Pickle encoded (protocol=0) query numpy array')
 
+    parser.add_argument('--top_k', type=int, help='Return only top k classes and their probabilities', default=None)
+    parser.add_argument('--binary', action='store_true',
+                        help='Write prediction to stdout in the binary protocol instead of base64 pickle')
+
     # parser.add_argument('--image_resize', help='Size of scaled query (default = 84)', default=84)
 
     args = parser.parse_args()
@@ -69,9 +107,14 @@ if __name__ == '__main__':
         query = unpickle_tensor(query)
 
     fitted = fit_model(model_name, support)
-    prediction = apply_model(fitted, query)
-    buffer = BytesIO()
-    torch.save(prediction, buffer)
-    prediction_bytes = buffer.getvalue()
-    buffer.close()
-    print(b64.b64encode(prediction_bytes).decode('utf-8'))
+    with torch.no_grad():
+        prediction = apply_model(fitted, query, top_k=args.top_k)
+
+    if args.binary:
+        write_binary_prediction(prediction, sys.stdout.buffer)
+    else:
+        buffer = BytesIO()
+        torch.save(prediction, buffer)
+        prediction_bytes = buffer.getvalue()
+        buffer.close()
+        print(b64.b64encode(prediction_bytes).decode('utf-8'))
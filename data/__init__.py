@@ -1,20 +1,38 @@
+import importlib
 import random
+from collections.abc import Mapping
+from functools import partial
 from os import listdir
 from os.path import isfile, join
 
-import imageio
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 
+def image_to_tensor(transform, path):
+    import imageio
+
+    img = imageio.imread(path)
+    return transform(img)
+
+
 class ImageDirDataset(Dataset):
-    def __init__(self, data_dir, transform, preload_to_ram=False):
+    # preload_to_ram: all samples are transformed once, in preload_workers processes, into one contiguous array
+    # in shared memory or preload_file that DataLoader workers map without copying
+
+    def __init__(self, data_dir, transform, preload_to_ram=False, preload_file=None, preload_workers=None):
         self.dir = data_dir
         self.transform = transform
         self.files = self.get_files()
         self.data = None
-        if preload_to_ram:
-            self.data = [self.image_to_tensor(file) for file in self.files]
+        if preload_to_ram and not self.files:
+            self.data = []
+        elif preload_to_ram:
+            from data.cache import preload
+
+            self.data = preload(self.files, partial(image_to_tensor, transform), path=preload_file,
+                                workers=preload_workers)
 
     def __getitem__(self, index):
         if self.data is None:
@@ -32,8 +50,7 @@ class ImageDirDataset(Dataset):
         return files
 
     def image_to_tensor(self, path):
-        img = imageio.imread(path)
-        return self.transform(img)
+        return image_to_tensor(self.transform, path)
 
 
 class LabeledSubdataset(Dataset):
@@ -162,11 +179,13 @@ class LabeledSubdataset(Dataset):
         batch_indices = random.sample(self.indices, size)
         items = []
         labels = []
+        is_test = []
         for i in batch_indices:
-            item, label, _ = self.base_dataset[i]
+            item, label, item_is_test = self.base_dataset[i]
             items.append(item)
             labels.append(label)
-        return torch.stack(items), torch.tensor(labels)
+            is_test.append(item_is_test)
+        return self.prepare_batch(torch.stack(items), is_test), torch.tensor(labels)
 
     def balanced_batch(self, per_class):
         classes = {}
@@ -186,14 +205,33 @@ class LabeledSubdataset(Dataset):
 
         items = []
         labels = []
+        is_test = []
         for i in indices:
-            item, label, _ = self.base_dataset[i]
+            item, label, item_is_test = self.base_dataset[i]
             items.append(item)
             labels.append(label)
-        return torch.stack(items), torch.tensor(labels)
+            is_test.append(item_is_test)
+        return self.prepare_batch(torch.stack(items), is_test), torch.tensor(labels)
+
+    def prepare_batch(self, batch, is_test=None):
+        return prepare_batch(self.base_dataset, batch, is_test)
+
+
+def prepare_batch(dataset, batch, is_test=None):
+    # gathered items of dataset -> normalized float batch
+    if hasattr(dataset, 'prepare_batch'):
+        return dataset.prepare_batch(batch, is_test)
+    from data.preprocessing import to_float_batch
+
+    return to_float_batch(batch)
 
 
 class LabeledDataset(Dataset):
+    # data.image_transforms.BatchAugmentation of datasets that return stored tensors, applied by prepare_batch
+    batch_augmentation = None
+    # stored images are resized to it by prepare_batch
+    batch_image_size = None
+
     def __init__(self, items, labels, test):
         self.classes = len(set(labels))
         self.data = list(map(list, zip(items, labels, test)))
@@ -205,6 +243,23 @@ class LabeledDataset(Dataset):
     def __getitem__(self, index):
         return self.data[index][0].load(), self.data[index][1], self.data[index][2]
 
+    def prepare_batch(self, batch, is_test=None):
+        # stacked items (..., 3, h, w), uint8 or normalized -> normalized float batch, items with
+        # is_test = 0 are augmented
+        # imported here, looking up a dataset does not load PIL and torchvision
+        from data.preprocessing import to_float_batch, to_unit_batch, standardize_
+
+        if self.batch_augmentation is None and self.batch_image_size is None:
+            return to_float_batch(batch)
+        shape = batch.shape
+        x = to_unit_batch(batch.reshape(-1, *shape[-3:]))
+        if self.batch_image_size is not None:
+            x = F.interpolate(x, size=self.batch_image_size, mode='bilinear', align_corners=False)
+        if self.batch_augmentation is not None:
+            train_mask = None if is_test is None else torch.as_tensor(is_test).reshape(-1) == 0
+            x = self.batch_augmentation(x, train_mask)
+        return standardize_(x).reshape(*shape[:-2], *x.shape[-2:])
+
     def get_label(self, index):
         return self.data[index][1]
 
@@ -215,24 +270,50 @@ class LabeledDataset(Dataset):
         return self.data[index][2]
 
 
-from data.cifar10 import CIFAR10Dataset, CIFAR100Dataset
-from data.gtsrb import GTSRBDataset
-from data.cub import CUBDataset
-from data.mini_imagenet import MiniImageNetDataset, MiniImageNetTestDataset
-from data.google_landmarks import GoogleLandmarksDataset, GoogleLandmarksDataset2, \
-    GoogleLandmarksDatasetSelfSupervision, GoogleLandmarksDatasetTest
-from data.taco import TacoDataset
-
-LABELED_DATASETS = {
-    'cifar10': CIFAR10Dataset,
-    'cifar100': CIFAR100Dataset,
-    'gtsrb': GTSRBDataset,
-    'cub': CUBDataset,
-    'miniImageNet': MiniImageNetDataset,
-    'miniImageNet-test': MiniImageNetTestDataset,
-    'taco': TacoDataset,
-    'google-landmarks': GoogleLandmarksDataset,
-    'google-landmarks-2': GoogleLandmarksDataset2,
-    'google-landmarks-selfsupervision': GoogleLandmarksDatasetSelfSupervision,
-    'google-landmarks-test': GoogleLandmarksDatasetTest,
-}
+class LazyRegistry(Mapping):
+    # name -> 'module:attribute', the module is imported on the first lookup of the name.
+    # Listing names and membership tests import nothing.
+
+    def __init__(self, entries):
+        self.entries = dict(entries)
+        self.resolved = {}
+
+    def __getitem__(self, name):
+        if name not in self.resolved:
+            module_name, attribute = self.entries[name].split(':')
+            self.resolved[name] = getattr(importlib.import_module(module_name), attribute)
+        return self.resolved[name]
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+LABELED_DATASETS = LazyRegistry({
+    'cifar10': 'data.cifar10:CIFAR10Dataset',
+    'cifar100': 'data.cifar10:CIFAR100Dataset',
+    'gtsrb': 'data.gtsrb:GTSRBDataset',
+    'cub': 'data.cub:CUBDataset',
+    'miniImageNet': 'data.mini_imagenet:MiniImageNetDataset',
+    'miniImageNet-test': 'data.mini_imagenet:MiniImageNetTestDataset',
+    'taco': 'data.taco:TacoDataset',
+    'google-landmarks': 'data.google_landmarks:GoogleLandmarksDataset',
+    'google-landmarks-2': 'data.google_landmarks:GoogleLandmarksDataset2',
+    'google-landmarks-selfsupervision': 'data.google_landmarks:GoogleLandmarksDatasetSelfSupervision',
+    'google-landmarks-test': 'data.google_landmarks:GoogleLandmarksDatasetTest',
+})
+
+# dataset classes are still available as attributes of the package, imported on first access
+_DATASET_CLASSES = {entry.split(':')[1]: entry for entry in LABELED_DATASETS.entries.values()}
+
+
+def __getattr__(name):
+    if name in _DATASET_CLASSES:
+        module_name, attribute = _DATASET_CLASSES[name].split(':')
+        return getattr(importlib.import_module(module_name), attribute)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
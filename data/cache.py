@@ -0,0 +1,253 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+DECODE_CHUNK = 1024
+
+
+def save_array(path, array):
+    # complete or absent: readers never see a partially written cache
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.save(fout, array)
+    os.replace(tmp_path, path)
+
+
+class MemmapArray(object):
+    # Read-only .npy memmap, opened on first access. Pickling keeps only the path,
+    # DataLoader workers map the file themselves instead of receiving a copy of the data.
+
+    def __init__(self, path):
+        self.path = path
+        self.array = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'array': None}
+
+    def open(self):
+        if self.array is None:
+            self.array = np.load(self.path, mmap_mode='r')
+        return self.array
+
+    def __len__(self):
+        return len(self.open())
+
+    def __getitem__(self, index) -> torch.Tensor:
+        return torch.from_numpy(np.array(self.open()[index]))
+
+
+class ArrayItem(object):
+    def __init__(self, array: MemmapArray, index: int):
+        self.array = array
+        self.index = index
+
+    def load(self):
+        return self.array[self.index]
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return "%s|%d|%d" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def cached_images(paths, cache_dir, image_size, name='images', workers=None) -> MemmapArray:
+    # Decoded, resized and center cropped uint8 images (len(paths), 3, image_size, image_size), row i is paths[i].
+    # <name>-<image_size>.json holds (path, mtime, size) keys of the rows: changed or new files are decoded
+    # again, the rest is copied from the previous cache.
+    from data.preprocessing import load_images_into
+
+    os.makedirs(cache_dir, exist_ok=True)
+    array_path = os.path.join(cache_dir, "%s-%d.npy" % (name, image_size))
+    keys_path = os.path.join(cache_dir, "%s-%d.json" % (name, image_size))
+    keys = [file_key(path) for path in paths]
+
+    old_keys = []
+    if os.path.exists(keys_path) and os.path.exists(array_path):
+        with open(keys_path) as fin:
+            old_keys = json.load(fin)
+        if old_keys == keys:
+            return MemmapArray(array_path)
+
+    old_rows = {key: i for i, key in enumerate(old_keys)}
+    old_array = np.load(array_path, mmap_mode='r') if old_rows else None
+    missing = [i for i, key in enumerate(keys) if key not in old_rows]
+    print("Image cache %s: %d of %d images to decode" % (array_path, len(missing), len(keys)))
+
+    tmp_path = array_path + '.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(keys), 3, image_size, image_size))
+    for i, key in enumerate(keys):
+        if key in old_rows:
+            array[i] = old_array[old_rows[key]]
+    decoded = torch.empty(min(len(missing), DECODE_CHUNK), 3, image_size, image_size, dtype=torch.uint8)
+    for start in range(0, len(missing), DECODE_CHUNK):
+        rows = missing[start:start + DECODE_CHUNK]
+        load_images_into(decoded[:len(rows)], [paths[i] for i in rows], image_size, workers=workers)
+        array[rows] = decoded[:len(rows)].numpy()
+    array.flush()
+    del array, old_array
+
+    # the keys are removed first: a crash between the two replaces leaves no keys, not wrong ones
+    if os.path.exists(keys_path):
+        os.remove(keys_path)
+    os.replace(tmp_path, array_path)
+    with open(keys_path + '.tmp', 'w') as fout:
+        json.dump(keys, fout)
+    os.replace(keys_path + '.tmp', keys_path)
+    return MemmapArray(array_path)
+
+
+MANIFEST_PATTERN = ".manifest-%s.json"
+
+
+def _dir_mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def _class_dirs(root):
+    return sorted(e.name for e in os.scandir(root) if e.is_dir())
+
+
+def scan_folder(root, extensions):
+    # the file list of torchvision DatasetFolder: sorted class directories, files of every class sorted by walk
+    extensions = tuple(ext.lower() for ext in extensions)
+    classes = _class_dirs(root)
+    dirs = {}
+    samples = []
+    for target, class_name in enumerate(classes):
+        for dir_path, _, file_names in sorted(os.walk(os.path.join(root, class_name), followlinks=True)):
+            dirs[os.path.relpath(dir_path, root)] = _dir_mtime(dir_path)
+            for file_name in sorted(file_names):
+                if file_name.lower().endswith(extensions):
+                    path = os.path.join(dir_path, file_name)
+                    samples.append((os.path.relpath(path, root), target, os.path.getsize(path)))
+    return {'classes': classes, 'dirs': dirs, 'samples': samples}
+
+
+def _manifest_valid(root, manifest):
+    # root is checked by its class directories, not by its mtime, that changes with the manifest file itself
+    try:
+        if _class_dirs(root) != manifest['classes']:
+            return False
+        return all(_dir_mtime(os.path.join(root, path)) == mtime for path, mtime in manifest['dirs'].items())
+    except OSError:
+        return False
+
+
+def folder_manifest(root, extensions):
+    # Scan of root cached in <root>/.manifest-<extensions>.json, valid while the mtimes of all scanned
+    # class directories are unchanged (a file is added, removed or renamed) and root has the same class
+    # directories. Costs one stat per directory instead of a walk over all files.
+    path = os.path.join(root, MANIFEST_PATTERN % '-'.join(ext.strip('.').lower() for ext in extensions))
+    if os.path.exists(path):
+        try:
+            with open(path) as fin:
+                manifest = json.load(fin)
+            if _manifest_valid(root, manifest):
+                return manifest
+        except ValueError:
+            pass
+
+    manifest = scan_folder(root, extensions)
+    try:
+        with open(path + '.tmp', 'w') as fout:
+            json.dump(manifest, fout)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # read-only dataset
+        pass
+    return manifest
+
+
+class CachedDatasetFolder(Dataset):
+    # torchvision DatasetFolder (samples, targets, classes, class_to_idx, (sample, target) items)
+    # built from folder_manifest
+
+    def __init__(self, root, loader, extensions, transform=None):
+        self.root = root
+        self.loader = loader
+        self.transform = transform
+
+        manifest = folder_manifest(root, extensions)
+        self.classes = manifest['classes']
+        self.class_to_idx = {class_name: i for i, class_name in enumerate(self.classes)}
+        self.samples = [(os.path.join(root, path), target) for path, target, _ in manifest['samples']]
+        self.targets = [target for _, target in self.samples]
+        self.sizes = [size for _, _, size in manifest['samples']]
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample, target
+
+    def __len__(self):
+        return len(self.samples)
+
+
+SHARED_MEMORY_DIR = "/dev/shm"
+PRELOAD_CHUNK = 256
+
+
+def _remove_file(path, pid):
+    # only the creating process removes it, forked workers run atexit handlers too
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+def _preload_sample(array, index, file, sample, first_file):
+    sample = sample.numpy()
+    if sample.shape != array.shape[1:]:
+        raise ValueError("%s: sample shape %s differs from %s of %s, samples of different shapes can not be "
+                         "preloaded" % (file, sample.shape, array.shape[1:], first_file))
+    array[index] = sample
+
+
+def _preload_job(job):
+    path, start, files, load_fn, first_file = job
+    array = np.load(path, mmap_mode='r+')
+    for i, file in enumerate(files):
+        _preload_sample(array, start + i, file, load_fn(file), first_file)
+    array.flush()
+
+
+def preload(files, load_fn, path=None, workers=None) -> MemmapArray:
+    # load_fn(file) -> tensor for every file, written by a process pool into one contiguous .npy file.
+    # DataLoader workers map that file instead of copying the samples: it lives in path, or in shared memory
+    # (/dev/shm, a temporary file elsewhere) and is removed at exit. All samples must have the same shape.
+    import atexit
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not files:
+        raise ValueError("Nothing to preload")
+    first = load_fn(files[0])
+    if path is None:
+        directory = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+        fd, path = tempfile.mkstemp(prefix='preload-', suffix='.npy', dir=directory)
+        os.close(fd)
+        atexit.register(_remove_file, path, os.getpid())
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=first.numpy().dtype,
+                                      shape=(len(files),) + tuple(first.shape))
+    array[0] = first.numpy()
+    array.flush()
+    del array
+
+    jobs = [(path, start, files[start:start + PRELOAD_CHUNK], load_fn, files[0])
+            for start in range(1, len(files), PRELOAD_CHUNK)]
+    try:
+        if workers == 1 or len(jobs) <= 1:
+            for job in jobs:
+                _preload_job(job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(_preload_job, jobs):
+                    pass
+    except BaseException:
+        # a partially filled array is of no use, free the shared memory now
+        os.remove(path)
+        raise
+    return MemmapArray(path)
@@ -1,86 +1,55 @@
+import os
 import random
 
+import numpy as np
 import torchvision
-from torchvision.datasets import CIFAR10
-from torchvision.transforms import transforms
 
 import data
+from data.cache import MemmapArray, ArrayItem, save_array
+from data.image_transforms import BatchAugmentation
 
-resize = transforms.Compose(
-    [
-        transforms.Resize(224),
-        transforms.CenterCrop(224),
-    ]
-)
+IMAGE_SIZE = 224
 
-augment = transforms.Compose(
-    [
-        transforms.RandomRotation(degrees=15),
-        transforms.RandomHorizontalFlip(p=0.25),
-        # transforms.RandomCrop(10),
-        # transforms.RandomPerspective(p=1),
-    ]
-)
 
-normalize = transforms.Compose(
-    [
-        transforms.ToTensor(),
-        transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-    ]
-)
+def augmentation(augment_prob):
+    # RandomApply([RandomRotation(15), RandomHorizontalFlip(0.25)], augment_prob) of the PIL pipeline
+    return BatchAugmentation(p=augment_prob, flip=0.25, degrees=15, padding_mode='zeros')
 
 
-class ImageItem(object):
-    def __init__(self, source: CIFAR10, index: int):
-        self.source = source
-        self.index = index
+def cifar_cache(source_class, root, name):
+    # Train and test images of a torchvision CIFAR dataset as one uint8 (n, 3, 32, 32) array on disk.
+    # -> (images, labels, number of train images), the arrays are read only on first access
+    images_path = os.path.join(root, "%s-uint8.npy" % name)
+    labels_path = os.path.join(root, "%s-labels.npy" % name)
+    if not os.path.exists(images_path) or not os.path.exists(labels_path):
+        train = source_class(root=root, train=True, download=True)
+        test = source_class(root=root, train=False, download=True)
+        save_array(images_path, np.concatenate([train.data, test.data]).transpose(0, 3, 1, 2))
+        save_array(labels_path, np.array(list(train.targets) + list(test.targets) + [len(train.targets)],
+                                         dtype=np.int64))
 
-    def load(self):
-        return self.source[self.index][0]
+    labels = np.load(labels_path)
+    return MemmapArray(images_path), labels[:-1].tolist(), int(labels[-1])
 
 
-class CIFAR10Dataset(data.LabeledDataset):
-    CLASSES = 10
+class CIFARDatasetBase(data.LabeledDataset):
+    # Items are 32x32 uint8 tensors, resizing to image_size, augmentation and normalization run on
+    # gathered batches in prepare_batch
 
-    def __init__(self, root="C:\\datasets", augment_prob=0.0, reduce=0.0,
-                 random_seed=42, **kwargs):
+    def __init__(self, source_class, name, root, augment_prob, reduce, random_seed, image_size=IMAGE_SIZE):
         self.reduce = reduce
         random.seed(random_seed)
 
-        self.test_transform = transforms.Compose(
-            [
-                resize,
-                normalize
-            ]
-        )
-        self.train_transform = transforms.Compose(
-            [
-                resize,
-                transforms.RandomApply([augment], p=augment_prob),
-                normalize
-            ]
-        )
-
-        self.source_dataset_train = torchvision.datasets.CIFAR10(root=root, train=True,
-                                                                 download=True)
-        self.source_dataset_test = torchvision.datasets.CIFAR10(root=root, train=False,
-                                                                download=True)
-
-        self.dataset_train_size = len(self.source_dataset_train)
-        self.dataset_test_size = len(self.source_dataset_test)
-        items = []
-        labels = []
-        for i in range(self.dataset_train_size):
-            items.append(ImageItem(self.source_dataset_train, i))
-            labels.append(self.source_dataset_train[i][1])
-        is_test = [0] * self.dataset_train_size
-
-        for i in range(self.dataset_test_size):
-            items.append(ImageItem(self.source_dataset_test, i))
-            labels.append(self.source_dataset_test[i][1])
-        is_test += [1] * self.dataset_test_size
-
-        super(CIFAR10Dataset, self).__init__(items, labels, is_test)
+        self.batch_image_size = image_size
+        if augment_prob > 0:
+            self.batch_augmentation = augmentation(augment_prob)
+
+        images, labels, self.dataset_train_size = cifar_cache(source_class, root, name)
+        self.dataset_test_size = len(labels) - self.dataset_train_size
+        items = [ArrayItem(images, i) for i in range(len(labels))]
+        is_test = [0] * self.dataset_train_size + [1] * self.dataset_test_size
+
+        super(CIFARDatasetBase, self).__init__(items, labels, is_test)
 
         self.train_subdataset, self.test_subdataset = self.subdataset.train_test_split()
 
@@ -89,15 +58,6 @@ class CIFAR10Dataset(data.LabeledDataset):
         else:
             self.train_subdataset = self.train_subdataset.balance(reduce)
 
-    def __getitem__(self, item):
-        image, label, is_test = super(CIFAR10Dataset, self).__getitem__(item)
-        if is_test:
-            image = self.test_transform(image)
-        else:
-            image = self.train_transform(image)
-
-        return image, label, is_test
-
     def label_stat(self):
         pass
 
@@ -108,70 +68,19 @@ class CIFAR10Dataset(data.LabeledDataset):
         return self.test_subdataset
 
 
-class CIFAR100Dataset(data.LabeledDataset):
-    CLASSES = 100
+class CIFAR10Dataset(CIFARDatasetBase):
+    CLASSES = 10
 
     def __init__(self, root="C:\\datasets", augment_prob=0.0, reduce=0.0,
-                 random_seed=42):
-        self.reduce = reduce
-        random.seed(random_seed)
-
-        self.test_transform = transforms.Compose(
-            [
-                resize,
-                normalize
-            ]
-        )
-        self.train_transform = transforms.Compose(
-            [
-                resize,
-                transforms.RandomApply([augment], p=augment_prob),
-                normalize
-            ]
-        )
-
-        self.source_dataset_train = torchvision.datasets.CIFAR100(root=root, train=True,
-                                                                  download=True)
-        self.source_dataset_test = torchvision.datasets.CIFAR100(root=root, train=False,
-                                                                 download=True)
-
-        self.dataset_train_size = len(self.source_dataset_train)
-        self.dataset_test_size = len(self.source_dataset_test)
-        items = []
-        labels = []
-        for i in range(self.dataset_train_size):
-            items.append(ImageItem(self.source_dataset_train, i))
-            labels.append(self.source_dataset_train[i][1])
-        is_test = [0] * self.dataset_train_size
-
-        for i in range(self.dataset_test_size):
-            items.append(ImageItem(self.source_dataset_test, i))
-            labels.append(self.source_dataset_test[i][1])
-        is_test += [1] * self.dataset_test_size
-
-        super(CIFAR100Dataset, self).__init__(items, labels, is_test)
-
-        self.train_subdataset, self.test_subdataset = self.subdataset.train_test_split()
-
-        if reduce < 1:
-            self.train_subdataset = self.train_subdataset.downscale(1 - reduce)
-        else:
-            self.train_subdataset = self.train_subdataset.balance(reduce)
-
-    def __getitem__(self, item):
-        image, label, is_test = super(CIFAR100Dataset, self).__getitem__(item)
-        if is_test:
-            image = self.test_transform(image)
-        else:
-            image = self.train_transform(image)
-
-        return image, label, is_test
+                 random_seed=42, **kwargs):
+        super(CIFAR10Dataset, self).__init__(torchvision.datasets.CIFAR10, 'cifar10', root, augment_prob, reduce,
+                                             random_seed)
 
-    def label_stat(self):
-        pass
 
-    def train(self):
-        return self.train_subdataset
+class CIFAR100Dataset(CIFARDatasetBase):
+    CLASSES = 100
 
-    def test(self):
-        return self.test_subdataset
+    def __init__(self, root="C:\\datasets", augment_prob=0.0, reduce=0.0,
+                 random_seed=42, **kwargs):
+        super(CIFAR100Dataset, self).__init__(torchvision.datasets.CIFAR100, 'cifar100', root, augment_prob, reduce,
+                                              random_seed)
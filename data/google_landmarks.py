@@ -1,29 +1,29 @@
 import os
 import random
-import shutil
-import time
-from io import BytesIO
-from typing import Union
 
-import requests
 import torch
-import torchvision
-from PIL import Image
-from torchvision.datasets import ImageFolder, DatasetFolder
-from torchvision.transforms import transforms
 
 import data
+from data.cache import CachedDatasetFolder
+from data.image_transforms import BatchAugmentation
+from data.preprocessing import load_resized_bytes, random_crops
+from data.shards import is_shard_dir, PackedShards, ShardItem
 
 MEAN = (0.485, 0.456, 0.406)
 STD = (0.229, 0.224, 0.225)
 
+# self-supervision: views per id and size of the stored source image relative to a view,
+# 3 as the Resize(image_size * 3) before RandomCrop(image_size) of the PIL pipeline
+CROPS_NUM = 8
+SOURCE_SCALE = 3
+
 
 def tensor_loader(path):
     return torch.load(path)
 
 
 class ImageItem(object):
-    def __init__(self, source: Union[ImageFolder, DatasetFolder], index: int):
+    def __init__(self, source: CachedDatasetFolder, index: int):
         self.source = source
         self.index = index
 
@@ -33,22 +33,33 @@ class ImageItem(object):
 
 class GoogleLandmarksDatasetBase(data.LabeledDataset):
     def __init__(self, root, reduce,
-                 random_seed, **kwargs):
-        self.CLASSES = len(os.listdir(root))
-
+                 random_seed, augment_prob=0.0, **kwargs):
         self.reduce = reduce
         random.seed(random_seed)
+        if augment_prob > 0:
+            self.batch_augmentation = BatchAugmentation(p=augment_prob)
 
-        self.source_dataset_train = torchvision.datasets.DatasetFolder(root=root, loader=tensor_loader,
-                                                                       extensions=('pt',))
-
-        self.dataset_train_size = len(self.source_dataset_train)
         items = []
         labels = []
+        if is_shard_dir(root):
+            # written by load_from_index, classes are numbered in sorted order as DatasetFolder does
+            shards = PackedShards(root)
+            entries = list(shards.entries())
+            class_to_idx = {label: i for i, label in enumerate(sorted(set(label for _, _, label, _ in entries)))}
+            for shard_index, position, label, _ in entries:
+                entry_items = self.shard_items(shards, shard_index, position)
+                items += entry_items
+                labels += [class_to_idx[label]] * len(entry_items)
+            self.CLASSES = len(class_to_idx)
+        else:
+            self.source_dataset_train = CachedDatasetFolder(root=root, loader=tensor_loader, extensions=('pt',))
+            self.CLASSES = len(self.source_dataset_train.classes)
+            for i in range(len(self.source_dataset_train)):
+                items.append(ImageItem(self.source_dataset_train, i))
+                labels.append(self.source_dataset_train.targets[i])
+
+        self.dataset_train_size = len(items)
         is_test = [0] * self.dataset_train_size
-        for i in range(self.dataset_train_size):
-            items.append(ImageItem(self.source_dataset_train, i))
-            labels.append(self.source_dataset_train[i][1])
 
         super(GoogleLandmarksDatasetBase, self).__init__(items, labels, is_test)
 
@@ -59,6 +70,9 @@ class GoogleLandmarksDatasetBase(data.LabeledDataset):
         else:
             self.train_subdataset = self.train_subdataset.balance(reduce)
 
+    def shard_items(self, shards: PackedShards, shard_index, position):
+        return [ShardItem(shards, shard_index, position)]
+
     def __getitem__(self, item):
         image, label, is_test = super(GoogleLandmarksDatasetBase, self).__getitem__(item)
         return image, label, is_test
@@ -86,10 +100,25 @@ class GoogleLandmarksDataset2(GoogleLandmarksDatasetBase):
 
 
 class GoogleLandmarksDatasetSelfSupervision(GoogleLandmarksDatasetBase):
+    # Every id is a class. Shards of load_from_selfsupervision_index hold one source image per id,
+    # it is presented as views_num items. Items load the whole source, prepare_batch replaces every
+    # source of the gathered batch with a random crop, new ones on every batch.
     def __init__(self, root=r"C:\datasets\google-landmarks\train\image-tensors-selfsupervision", reduce=0.0,
-                 random_seed=42, **kwargs):
+                 random_seed=42, image_size=84, views_num=CROPS_NUM, **kwargs):
+        self.image_size = image_size
+        self.views_num = views_num
         super(GoogleLandmarksDatasetSelfSupervision, self).__init__(root, reduce, random_seed, **kwargs)
 
+    def shard_items(self, shards: PackedShards, shard_index, position):
+        return [ShardItem(shards, shard_index, position) for _ in range(self.views_num)]
+
+    def prepare_batch(self, batch, is_test=None):
+        # crops of the whole batch (..., 3, source size, source size) in one gather
+        shape = batch.shape
+        views = random_crops(batch.reshape(-1, *shape[-3:]), self.image_size)
+        views = views.reshape(*shape[:-2], *views.shape[-2:])
+        return super(GoogleLandmarksDatasetSelfSupervision, self).prepare_batch(views, is_test)
+
 
 class GoogleLandmarksDatasetTest(GoogleLandmarksDatasetBase):
     def __init__(self, root=r"C:\datasets\google-landmarks\test\image-tensors", reduce=0.0,
@@ -97,143 +126,44 @@ class GoogleLandmarksDatasetTest(GoogleLandmarksDatasetBase):
         super(GoogleLandmarksDatasetTest, self).__init__(root, reduce, random_seed, **kwargs)
 
 
-import pandas as pd
+def decode_resized(content, image_size):
+    return load_resized_bytes(content, image_size)
 
-ATTEMPTS = 3
-SLEEP = 1
 
+def index_jobs(index, label_column):
+    for image_id, label, url in zip(index['id'], index[label_column], index['url']):
+        yield str(image_id), str(label), str(url)
 
-def load_from_index(source=r'C:\datasets\google-landmarks\train\filtered_train_2.csv',
-                    target=r'C:\datasets\google-landmarks\train\image-tensors-2',
-                    image_size=84):
-    resize = transforms.Compose(
-        [
-            transforms.Resize(image_size),
-            transforms.CenterCrop(image_size),
-        ]
-    )
-
-    normalize = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=MEAN, std=STD)
-        ]
-    )
-
-    transform = transforms.Compose(
-        [
-            resize,
-            normalize
-        ]
-    )
-    index = pd.read_csv(source)
-    for i, row in enumerate(index.iterrows()):
-        done = False
-        url = None
-        attempts = 0
-        while not done:
-            attempts += 1
-            try:
-                label = str(row[1]['landmark_id'])
-                label_folder = os.path.join(target, label)
-                image_id = str(row[1]['id'])
-                image_path = os.path.join(label_folder, image_id + r'.pt')
-                if os.path.exists(image_path):
-                    break
-
-                url = str(row[1]['url'])
-
-                os.makedirs(label_folder, exist_ok=True)
-
-                response = requests.get(url)
-                pil_image = Image.open(BytesIO(response.content))
-                pil_image = pil_image.convert('RGB')
-                image_tensor = transform(pil_image)
-
-                torch.save(image_tensor, image_path)
-
-                done = True
-            except (OSError, AttributeError):
-                if attempts <= ATTEMPTS:
-                    print("Error with url %s, delay for %d second(s)" % (url, SLEEP))
-                    time.sleep(SLEEP)
-                else:
-                    done = True
-                    print("Skipped")
-
-        if i % 50 == 0:
-            print(i)
 
+def load_from_index(source=r'C:\datasets\google-landmarks\train\filtered_train_2.csv',
+                    target=r'C:\datasets\google-landmarks\train\image-shards-2',
+                    image_size=84, **kwargs):
+    # kwargs: download_workers, decode_workers, host_rate, attempts, ... of data.ingestion.ingest
+    import pandas as pd
+    from data.ingestion import ingest
 
-CROPS_NUM = 8
+    index = pd.read_csv(source)
+    return ingest(index_jobs(index, 'landmark_id'), target, decode_resized, (image_size,), **kwargs)
 
 
 def load_from_selfsupervision_index(source=r'C:\datasets\google-landmarks\train\filtered_train_selfsupervision.csv',
-                                    target=r'C:\datasets\google-landmarks\train\image-tensors-selfsupervision',
-                                    image_size=84):
-    resize = transforms.Compose(
-        [
-            transforms.Resize(image_size * 3),
-            transforms.RandomCrop(image_size),
-            transforms.RandomHorizontalFlip(),
-        ]
-    )
-
-    normalize = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=MEAN, std=STD)
-        ]
-    )
-
-    transform = transforms.Compose(
-        [
-            resize,
-            normalize
-        ]
-    )
+                                    target=r'C:\datasets\google-landmarks\train\image-shards-selfsupervision',
+                                    image_size=84, **kwargs):
+    # every image is its own class, crops of the stored source are drawn by GoogleLandmarksDatasetSelfSupervision
+    import pandas as pd
+    from data.ingestion import ingest
+
     index = pd.read_csv(source)
-    for i, row in enumerate(index.iterrows()):
-        done = False
-        url = None
-        attempts = 0
-        while not done:
-            attempts += 1
-            try:
-                label = str(row[1]['id'])
-                label_folder = os.path.join(target, label)
-
-                url = str(row[1]['url'])
-
-                os.makedirs(label_folder, exist_ok=True)
-
-                response = requests.get(url)
-                pil_image = Image.open(BytesIO(response.content))
-                pil_image = pil_image.convert('RGB')
-                for crop_i in range(CROPS_NUM):
-                    image_id = str(crop_i)
-                    image_path = os.path.join(label_folder, image_id + r'.pt')
-                    if os.path.exists(image_path):
-                        break
-                    image_tensor = transform(pil_image)
-                    torch.save(image_tensor, image_path)
-
-                done = True
-            except (OSError, AttributeError):
-                if attempts <= ATTEMPTS:
-                    print("Error with url %s, delay for %d second(s)" % (url, SLEEP))
-                    time.sleep(SLEEP)
-                else:
-                    done = True
-                    print("Skipped")
-
-        if i % 50 == 0:
-            print(i)
+    return ingest(index_jobs(index, 'id'), target, decode_resized, (image_size * SOURCE_SCALE,), **kwargs)
 
 
 def remove_small(threshold, root=r"C:\datasets\google-landmarks\train\image-tensors-selfsupervision"):
+    import shutil
+
     for label in os.listdir(root):
         path = os.path.join(root, label)
+        if not os.path.isdir(path):
+            continue
         cnt = len(os.listdir(path))
         if cnt < threshold:
             print(label, cnt)
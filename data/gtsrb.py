@@ -1,12 +1,12 @@
 import os
 import random
 
-import pandas as pd
 import torch
 from PIL import Image
 from torchvision import transforms
 
 import data
+from data.cache import cached_images, ArrayItem
 
 MEAN = (0.485, 0.456, 0.406)
 STD = (0.229, 0.224, 0.225)
@@ -33,6 +33,8 @@ normalize = transforms.Compose(
 )
 
 CLASSES = 43
+CACHE_DIR = "cache"
+IMAGE_SIZE = 224
 
 
 class ImageItem(object):
@@ -48,8 +50,11 @@ class GTSRBDataset(data.LabeledDataset):
     CLASSES = 43
 
     def __init__(self, data_dir="C:\\datasets\\gtsrb-german-traffic-sign", augment_prob=0.0, reduce=0.0,
-                 random_seed=42, **kwargs):
+                 random_seed=42, cache=False, cache_dir=None, **kwargs):
+        # cache: items are decoded and resized once into a uint8 memmap in cache_dir (data_dir/cache by default),
+        # only the augmentation runs on every access
         self.reduce = reduce
+        self.cache = cache
         random.seed(random_seed)
 
         self.dir = data_dir
@@ -67,6 +72,8 @@ class GTSRBDataset(data.LabeledDataset):
             ]
         )
 
+        import pandas as pd
+
         self.train_data_file = os.path.join(data_dir, "Train.csv")
         self.test_data_file = os.path.join(data_dir, "Test.csv")
 
@@ -80,7 +87,14 @@ class GTSRBDataset(data.LabeledDataset):
         labels += list(test_data['ClassId'])
         is_test += [1] * len(test_data)
 
-        super(GTSRBDataset, self).__init__(list(map(ImageItem, files)), labels, is_test)
+        self.tensor_augment = transforms.RandomApply([augment], p=augment_prob)
+        if cache:
+            images = cached_images(files, cache_dir or os.path.join(data_dir, CACHE_DIR), IMAGE_SIZE)
+            items = [ArrayItem(images, i) for i in range(len(files))]
+        else:
+            items = list(map(ImageItem, files))
+
+        super(GTSRBDataset, self).__init__(items, labels, is_test)
 
         self.train_subdataset, self.test_subdataset = self.subdataset.train_test_split()
 
@@ -91,6 +105,12 @@ class GTSRBDataset(data.LabeledDataset):
 
     def __getitem__(self, item):
         image, label, is_test = super(GTSRBDataset, self).__getitem__(item)
+        if self.cache:
+            # uint8, normalized by prepare_batch
+            if not is_test:
+                image = self.tensor_augment(image)
+            return image, label, is_test
+
         if is_test:
             image = self.test_transform(image)
         else:
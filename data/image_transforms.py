@@ -1,3 +1,7 @@
+import math
+
+import torch
+import torch.nn.functional as F
 from torchvision import transforms
 
 RGB_NORMALIZATION = ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
@@ -38,3 +42,93 @@ def scaling_grayscale(size):
         transforms.Grayscale(),
         TO_GRAYSCALE_TENSOR
     ])
+
+
+class BatchAugmentation(object):
+    # Vectorized counterpart of RandomApply([RandomResizedCrop, RandomRotation, RandomHorizontalFlip, ColorJitter], p)
+    # for a whole gathered batch (n, 3, h, w) of [0, 1] floats, with independent random parameters per sample.
+    # Crop, rotation and flip are one affine grid_sample, the output keeps the input size.
+    # The defaults are the RandomHorizontalFlip(0.5) of the PIL pipelines; crop (scale), rotation (degrees)
+    # and jitter (brightness, contrast, saturation) are opt-in.
+
+    def __init__(self, p=1.0, flip=0.5, scale=None, ratio=(3 / 4, 4 / 3), degrees=0, brightness=0,
+                 contrast=0, saturation=0, padding_mode='border'):
+        self.p = p
+        self.flip = flip
+        self.scale = scale
+        self.ratio = ratio
+        self.degrees = degrees
+        self.padding_mode = padding_mode
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @staticmethod
+    def _uniform(n, bounds, device):
+        return torch.empty(n, device=device).uniform_(*bounds)
+
+    def geometric(self, x):
+        n = x.size(0)
+        device = x.device
+        if self.scale is None and not self.degrees:
+            # flip only, exact and without resampling
+            flip = (torch.rand(n, device=device) < self.flip).view(n, 1, 1, 1)
+            return torch.where(flip, x.flip(-1), x)
+        if self.scale is not None:
+            area = self._uniform(n, self.scale, device)
+            log_ratio = self._uniform(n, (math.log(self.ratio[0]), math.log(self.ratio[1])), device)
+            width = torch.sqrt(area * torch.exp(log_ratio)).clamp_(max=1)
+            height = torch.sqrt(area / torch.exp(log_ratio)).clamp_(max=1)
+            # crop centers in [-1, 1] coordinates of affine_grid, the crop stays inside the image
+            center_x = (torch.rand(n, device=device) * 2 - 1) * (1 - width)
+            center_y = (torch.rand(n, device=device) * 2 - 1) * (1 - height)
+        else:
+            width = height = torch.ones(n, device=device)
+            center_x = center_y = torch.zeros(n, device=device)
+        width = width * torch.where(torch.rand(n, device=device) < self.flip, -1.0, 1.0)
+        angle = self._uniform(n, (-math.radians(self.degrees), math.radians(self.degrees)), device)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # output -> input coordinates: rotation after the crop scaling
+        theta = torch.zeros(n, 2, 3, dtype=x.dtype, device=device)
+        theta[:, 0, 0] = cos * width
+        theta[:, 0, 1] = -sin * height
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 0] = sin * width
+        theta[:, 1, 1] = cos * height
+        theta[:, 1, 2] = center_y
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode=self.padding_mode, align_corners=False)
+
+    def jitter(self, x):
+        n = x.size(0)
+        device = x.device
+        if self.brightness:
+            x = x * self._uniform(n, (1 - self.brightness, 1 + self.brightness), device).view(n, 1, 1, 1)
+        if self.contrast:
+            mean = rgb_to_grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+            factor = self._uniform(n, (1 - self.contrast, 1 + self.contrast), device).view(n, 1, 1, 1)
+            x = (x - mean) * factor + mean
+        if self.saturation:
+            gray = rgb_to_grayscale(x)
+            factor = self._uniform(n, (1 - self.saturation, 1 + self.saturation), device).view(n, 1, 1, 1)
+            x = (x - gray) * factor + gray
+        return x.clamp_(0, 1)
+
+    def __call__(self, x: torch.Tensor, mask: torch.Tensor = None) -> torch.Tensor:
+        # mask: samples that may be augmented, e.g. not test ones
+        apply = torch.rand(x.size(0), device=x.device) < self.p
+        if mask is not None:
+            apply &= mask.to(x.device)
+        if not apply.any():
+            return x
+        if bool(apply.all()):
+            return self.jitter(self.geometric(x))
+        x = x.clone()
+        x[apply] = self.jitter(self.geometric(x[apply]))
+        return x
+
+
+def rgb_to_grayscale(x):
+    # (n, 3, h, w) -> (n, 1, h, w), ITU-R 601-2 luma as PIL and torchvision
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
@@ -0,0 +1,191 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from data.shards import ShardWriter, Manifest, SHARD_SIZE
+from utils import pretty_time
+
+DOWNLOAD_WORKERS = 32
+DECODE_WORKERS = None
+# requests per second to a single host
+HOST_RATE = 10.0
+ATTEMPTS = 4
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+TIMEOUT = 30
+# statuses that are worth another attempt, everything else >= 400 is final
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+PRINT_PERIOD = 500
+
+
+class DownloadError(Exception):
+    pass
+
+
+class HostRateLimiter(object):
+    # Spaces request starts to one host by 1 / rate seconds, hosts do not wait for each other
+
+    def __init__(self, rate=HOST_RATE):
+        self.interval = 0.0 if not rate else 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = {}
+
+    def acquire(self, host):
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start_time + self.interval
+        if start_time > now:
+            time.sleep(start_time - now)
+
+    def delay(self, host, seconds):
+        # Retry-After and 429 push back every request to the host
+        with self.lock:
+            self.next_time[host] = max(self.next_time.get(host, 0.0), time.monotonic() + seconds)
+
+
+class Downloader(object):
+    def __init__(self, workers=DOWNLOAD_WORKERS, host_rate=HOST_RATE, attempts=ATTEMPTS, backoff=BACKOFF,
+                 timeout=TIMEOUT):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(host_rate)
+
+        # one keep-alive pool per host, as large as the number of threads that may use it
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff_time(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(float(response.headers['Retry-After']), MAX_BACKOFF)
+        # full jitter
+        return random.uniform(0, min(self.backoff * 2 ** attempt, MAX_BACKOFF))
+
+    def get(self, url) -> bytes:
+        host = urlsplit(url).netloc
+        error = None
+        for attempt in range(self.attempts):
+            self.rate_limiter.acquire(host)
+            response = None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code < 400:
+                    return response.content
+                error = DownloadError("HTTP %d" % response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    break
+            except requests.RequestException as e:
+                error = DownloadError("%s: %s" % (type(e).__name__, e))
+
+            if attempt + 1 < self.attempts:
+                delay = self.backoff_time(attempt, response)
+                if response is not None and response.status_code == 429:
+                    self.rate_limiter.delay(host, delay)
+                time.sleep(delay)
+        raise error
+
+    def close(self):
+        self.session.close()
+
+
+def _download_job(downloader: Downloader, job):
+    image_id, label, url = job
+    return image_id, label, downloader.get(url)
+
+
+def ingest(jobs, target, decode_fn, decode_args=(), download_workers=DOWNLOAD_WORKERS, decode_workers=DECODE_WORKERS,
+           host_rate=HOST_RATE, attempts=ATTEMPTS, backoff=BACKOFF, timeout=TIMEOUT, shard_size=SHARD_SIZE,
+           retry_failed=False):
+    # jobs: iterable of (id, label, url). Downloads run in a thread pool, decode_fn(content, *decode_args)
+    # in a process pool, must be picklable and return a uint8 tensor (3, h, w) or (n, 3, h, w).
+    # Ids are written to the manifest of target when their shard is on disk, so an interrupted run
+    # continues where it stopped and downloads at most one unfinished shard again.
+    manifest = Manifest(target)
+    writer = ShardWriter(target, shard_size=shard_size)
+    downloader = Downloader(workers=download_workers, host_rate=host_rate, attempts=attempts, backoff=backoff,
+                            timeout=timeout)
+
+    stats = {'done': 0, 'failed': 0, 'skipped': 0}
+    start_time = time.time()
+
+    def print_progress():
+        processed = stats['done'] + stats['failed']
+        print("%d downloaded, %d failed, %d skipped\t%.1f images/s\t%s" % (
+            stats['done'], stats['failed'], stats['skipped'], processed / max(time.time() - start_time, 1e-9),
+            pretty_time(time.time() - start_time)))
+
+    def fail(image_id, error):
+        manifest.write([image_id], 'failed', error=str(error))
+        stats['failed'] += 1
+
+    def finish(future):
+        image_id, label = decodes.pop(future)
+        try:
+            images = future.result()
+        except Exception as e:
+            fail(image_id, e)
+            return
+        stats['done'] += 1
+        manifest.write(writer.add(image_id, label, images), 'done')
+        if stats['done'] % PRINT_PERIOD == 0:
+            print_progress()
+
+    downloads = {}
+    decodes = {}
+    # in-flight bound of each stage: downloaded content waiting for a decoder is kept in memory
+    max_downloads = 2 * download_workers
+    max_decodes = 2 * (decode_workers or os.cpu_count() or 1)
+    jobs = iter(jobs)
+    exhausted = False
+    try:
+        with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+                ProcessPoolExecutor(max_workers=decode_workers) as decode_pool:
+            while True:
+                while not exhausted and len(downloads) < max_downloads:
+                    try:
+                        image_id, label, url = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if manifest.done(image_id) or (image_id in manifest and not retry_failed):
+                        stats['skipped'] += 1
+                        continue
+                    downloads[download_pool.submit(_download_job, downloader, (image_id, label, url))] = image_id
+
+                if not downloads and not decodes:
+                    break
+
+                done, _ = wait(list(downloads) + list(decodes), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in decodes:
+                        finish(future)
+                        continue
+                    if future not in downloads:
+                        # a decode finished while waiting for a free decoder
+                        continue
+                    image_id = downloads.pop(future)
+                    try:
+                        _, label, content = future.result()
+                    except DownloadError as e:
+                        fail(image_id, e)
+                        continue
+                    while len(decodes) >= max_decodes:
+                        for decoded in wait(list(decodes), return_when=FIRST_COMPLETED)[0]:
+                            finish(decoded)
+                    decodes[decode_pool.submit(decode_fn, content, *decode_args)] = (image_id, label)
+    finally:
+        manifest.write(writer.flush(), 'done')
+        manifest.close()
+        downloader.close()
+
+    print_progress()
+    return stats
@@ -1,13 +1,14 @@
 import os
 import random
+from functools import partial
 
 import torch
-import torchvision
-from PIL import Image
-from torchvision.datasets import ImageFolder
 from torchvision.transforms import transforms
 
 import data
+from data.cache import CachedDatasetFolder
+from data.image_transforms import BatchAugmentation
+from data.preprocessing import load_resized, load_pil, IMAGE_EXTENSIONS
 
 MEAN = (0.485, 0.456, 0.406)
 STD = (0.229, 0.224, 0.225)
@@ -18,7 +19,7 @@ def tensor_loader(path):
 
 
 class ImageItem(object):
-    def __init__(self, source: ImageFolder, index: int):
+    def __init__(self, source: CachedDatasetFolder, index: int):
         self.source = source
         self.index = index
 
@@ -35,6 +36,9 @@ class MiniImageNetDataset(data.LabeledDataset):
         self.reduce = reduce
         self.tensors = tensors
         random.seed(random_seed)
+        if tensors and augment_prob > 0:
+            # stored tensors bypass train_transform, they are augmented after the batch is gathered
+            self.batch_augmentation = BatchAugmentation(p=augment_prob)
 
         resize_train = transforms.Compose(
             [
@@ -79,17 +83,18 @@ class MiniImageNetDataset(data.LabeledDataset):
             ]
         )
         if not tensors:
-            self.source_dataset_train = torchvision.datasets.ImageFolder(root=root)
+            # JPEGs are decoded at the smallest DCT scale that is still >= image_size
+            self.source_dataset_train = CachedDatasetFolder(root=root, loader=partial(load_pil, min_size=image_size),
+                                                            extensions=IMAGE_EXTENSIONS)
         else:
-            self.source_dataset_train = torchvision.datasets.DatasetFolder(root=root, loader=tensor_loader,
-                                                                           extensions=('pt',))
+            self.source_dataset_train = CachedDatasetFolder(root=root, loader=tensor_loader, extensions=('pt',))
 
         self.dataset_train_size = len(self.source_dataset_train)
         items = []
         labels = []
         for i in range(self.dataset_train_size):
             items.append(ImageItem(self.source_dataset_train, i))
-            labels.append(self.source_dataset_train[i][1])
+            labels.append(self.source_dataset_train.targets[i])
         is_test = [0] * self.dataset_train_size
 
         super(MiniImageNetDataset, self).__init__(items, labels, is_test)
@@ -129,27 +134,7 @@ class MiniImageNetTestDataset(MiniImageNetDataset):
 
 def save_as_tensors(source='C:\\datasets\\mini-imagenet\\train', target=r'C:\datasets\mini-imagenet\train_tensors',
                     image_size=84):
-    resize = transforms.Compose(
-        [
-            transforms.Resize(image_size),
-            transforms.CenterCrop(image_size),
-        ]
-    )
-
-    normalize = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=MEAN, std=STD)
-        ]
-    )
-
-    transform = transforms.Compose(
-        [
-            resize,
-            normalize
-        ]
-    )
-
+    # uint8 (3, image_size, image_size), normalized by the consumers after the batch is gathered
     os.makedirs(target, exist_ok=True)
     for i, class_label in enumerate(os.listdir(source)):
         cur_source = os.path.join(source, class_label)
@@ -158,11 +143,8 @@ def save_as_tensors(source='C:\\datasets\\mini-imagenet\\train', target=r'C:\dat
         for image in os.listdir(cur_source):
             source_image_file = os.path.join(cur_source, image)
             target_file = os.path.join(cur_target, image.replace('.JPEG', '.pt'))
-            with open(source_image_file, 'rb') as f:
-                img = Image.open(f)
-                img = img.convert('RGB')
-                image_tensor = transform(img)
-                torch.save(image_tensor, target_file)
+            # clone: the crop is a view of the whole decoded image
+            torch.save(load_resized(source_image_file, image_size).clone(), target_file)
         print(class_label, i)
 
 # if __name__ == '__main__':
@@ -0,0 +1,174 @@
+import math
+import os
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from PIL import Image
+from torchvision.transforms import functional as TF
+
+from data.image_transforms import RGB_NORMALIZATION
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+try:
+    from torchvision.io import decode_image, read_file, ImageReadMode
+except ImportError:
+    decode_image = None
+
+
+def is_image_file(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def list_images(path):
+    return sorted(e.path for e in os.scandir(path) if e.is_file() and is_image_file(e.name))
+
+
+def draft(img: Image.Image, min_size) -> Image.Image:
+    # JPEG DCT scaling: decode at 1/2, 1/4 or 1/8 of the resolution while the shorter side stays >= min_size
+    if img.format == 'JPEG':
+        scale = min_size / min(img.size)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    return img
+
+
+def load_pil(path, min_size=None) -> Image.Image:
+    # loader of ImageFolder datasets that resize to min_size afterwards
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        if min_size is not None:
+            draft(img, min_size)
+        return img.convert('RGB')
+
+
+def _decode_draft(fp, min_size):
+    img = Image.open(fp)
+    if img.format != 'JPEG' or min(img.size) < 2 * min_size:
+        return None
+    return TF.pil_to_tensor(draft(img, min_size).convert('RGB'))
+
+
+def decode_rgb(path, min_size=None) -> torch.Tensor:
+    # uint8 (3, height, width), JPEGs are decoded at reduced resolution if min_size is given
+    if min_size is not None:
+        with open(path, 'rb') as f:
+            img = _decode_draft(f, min_size)
+        if img is not None:
+            return img
+    if decode_image is not None:
+        try:
+            return decode_image(read_file(path), mode=ImageReadMode.RGB)
+        except RuntimeError:
+            pass
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        img = img.convert('RGB')
+        return TF.pil_to_tensor(img)
+
+
+def decode_rgb_bytes(content: bytes, min_size=None) -> torch.Tensor:
+    # uint8 (3, height, width) of an encoded image in memory
+    if min_size is not None:
+        img = _decode_draft(BytesIO(content), min_size)
+        if img is not None:
+            return img
+    if decode_image is not None:
+        try:
+            return decode_image(torch.frombuffer(bytearray(content), dtype=torch.uint8), mode=ImageReadMode.RGB)
+        except RuntimeError:
+            pass
+    img = Image.open(BytesIO(content))
+    img = img.convert('RGB')
+    return TF.pil_to_tensor(img)
+
+
+def resize_crop(img: torch.Tensor, image_size) -> torch.Tensor:
+    img = TF.resize(img, image_size, antialias=True)
+    return TF.center_crop(img, image_size)
+
+
+def load_resized(path, image_size) -> torch.Tensor:
+    return resize_crop(decode_rgb(path, min_size=image_size), image_size)
+
+
+def load_resized_bytes(content: bytes, image_size) -> torch.Tensor:
+    return resize_crop(decode_rgb_bytes(content, min_size=image_size), image_size)
+
+
+def _load_resized_job(job):
+    return load_resized(*job)
+
+
+def random_crops(images: torch.Tensor, size, flip=True) -> torch.Tensor:
+    # (n, c, h, w) -> (n, c, size, size): a random crop of every image, mirrored with probability 0.5 if flip,
+    # taken with one gather
+    n, c, h, w = images.shape
+    device = images.device
+    offsets = torch.arange(size, device=device)
+    rows = torch.randint(0, h - size + 1, (n, 1), device=device) + offsets
+    cols = torch.randint(0, w - size + 1, (n, 1), device=device) + offsets
+    if flip:
+        cols = torch.where(torch.rand(n, 1, device=device) < 0.5, cols.flip(1), cols)
+    return images[torch.arange(n, device=device).view(n, 1, 1, 1), torch.arange(c, device=device).view(1, c, 1, 1),
+                  rows.view(n, 1, size, 1), cols.view(n, 1, 1, size)]
+
+
+def _normalization(batch: torch.Tensor):
+    mean = torch.tensor(RGB_NORMALIZATION[0], dtype=batch.dtype, device=batch.device).view(3, 1, 1)
+    std = torch.tensor(RGB_NORMALIZATION[1], dtype=batch.dtype, device=batch.device).view(3, 1, 1)
+    return mean, std
+
+
+def standardize_(batch: torch.Tensor) -> torch.Tensor:
+    # [0, 1] float batch (..., 3, height, width) -> normalized as TO_RGB_TENSOR does, in place
+    mean, std = _normalization(batch)
+    return batch.sub_(mean).div_(std)
+
+
+def unstandardize(batch: torch.Tensor) -> torch.Tensor:
+    mean, std = _normalization(batch)
+    return batch * std + mean
+
+
+def normalize_(batch: torch.Tensor) -> torch.Tensor:
+    # uint8-range float batch (..., 3, height, width) -> normalized as TO_RGB_TENSOR does, in place
+    return standardize_(batch.div_(255))
+
+
+def to_float_batch(batch: torch.Tensor) -> torch.Tensor:
+    # datasets stored as uint8 are converted and normalized once per gathered batch, float batches pass through
+    if batch.dtype == torch.uint8:
+        return normalize_(batch.float())
+    return batch
+
+
+def to_unit_batch(batch: torch.Tensor) -> torch.Tensor:
+    # uint8 or normalized float batch -> [0, 1] float batch
+    if batch.dtype == torch.uint8:
+        return batch.float().div_(255)
+    return unstandardize(batch)
+
+
+def load_images_into(out: torch.Tensor, paths, image_size, workers=None, chunksize=16) -> torch.Tensor:
+    # out: (len(paths), 3, image_size, image_size) of any dtype, filled with the resized uint8 images
+    jobs = [(path, image_size) for path in paths]
+    if workers == 1 or len(jobs) <= 1:
+        for i, image in enumerate(map(_load_resized_job, jobs)):
+            out[i].copy_(image)
+    else:
+        # images are written into the result as soon as they are decoded, in order
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for i, image in enumerate(executor.map(_load_resized_job, jobs, chunksize=chunksize)):
+                out[i].copy_(image)
+    return out
+
+
+def images_to_tensor(paths, image_size, shape=None, workers=None, chunksize=16) -> torch.Tensor:
+    if shape is None:
+        shape = (len(paths),)
+    result = torch.empty(*shape, 3, image_size, image_size)
+    load_images_into(result.view(-1, 3, image_size, image_size), paths, image_size, workers=workers,
+                     chunksize=chunksize)
+    return normalize_(result)
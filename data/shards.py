@@ -0,0 +1,143 @@
+import json
+import os
+
+import torch
+
+# Packed shard format: a directory of shard-<n>.pt files, each one a torch.save'd dict
+#   {'images': uint8 tensor (n, 3, height, width), 'labels': [str, ...], 'ids': [str, ...]}
+# plus the manifest.jsonl of the ingestion that produced it
+SHARD_PATTERN = "shard-%05d.pt"
+SHARD_SIZE = 1024
+MANIFEST_FILE = "manifest.jsonl"
+
+
+def is_shard_dir(root):
+    return os.path.isdir(root) and any(is_shard_file(name) for name in os.listdir(root))
+
+
+def is_shard_file(name):
+    return name.startswith("shard-") and name.endswith(".pt")
+
+
+def list_shards(root):
+    return sorted(os.path.join(root, name) for name in os.listdir(root) if is_shard_file(name))
+
+
+def load_shard(path):
+    # memory-mapped, pages are read only for the images that are accessed
+    try:
+        return torch.load(path, mmap=True, weights_only=False)
+    except TypeError:
+        return torch.load(path)
+
+
+class ShardWriter(object):
+    # Buffers uint8 images and writes them as full shards. flush() returns the ids it has written,
+    # they may be marked as done in the manifest only after that.
+
+    def __init__(self, root, shard_size=SHARD_SIZE):
+        self.root = root
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+        shards = list_shards(root)
+        self.next_shard = int(os.path.basename(shards[-1])[6:-3]) + 1 if shards else 0
+
+        self.images = []
+        self.labels = []
+        self.ids = []
+
+    def add(self, image_id, label, images):
+        # images: uint8 tensor (3, height, width) or (n, 3, height, width), all stored with the same id and label
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        for image in images:
+            self.images.append(image)
+            self.labels.append(str(label))
+            self.ids.append(str(image_id))
+        if len(self.images) >= self.shard_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.images:
+            return []
+        path = os.path.join(self.root, SHARD_PATTERN % self.next_shard)
+        tmp_path = path + '.tmp'
+        torch.save({'images': torch.stack(self.images), 'labels': self.labels, 'ids': self.ids}, tmp_path)
+        os.replace(tmp_path, path)
+        self.next_shard += 1
+
+        ids = list(dict.fromkeys(self.ids))
+        self.images, self.labels, self.ids = [], [], []
+        return ids
+
+
+class Manifest(object):
+    # Append-only ingestion log: {"id": ..., "status": "done" | "failed", ...} per line, the last record of an id wins
+
+    def __init__(self, root):
+        self.path = os.path.join(root, MANIFEST_FILE)
+        self.status = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as fin:
+                for line in fin:
+                    if not line.endswith(b'\n'):
+                        # interrupted write
+                        break
+                    record = json.loads(line)
+                    self.status[record['id']] = record['status']
+        os.makedirs(root, exist_ok=True)
+        self.fout = open(self.path, 'a')
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.status
+
+    def done(self, image_id):
+        return self.status.get(str(image_id)) == 'done'
+
+    def write(self, ids, status, **kwargs):
+        lines = []
+        for image_id in ids:
+            record = {'id': str(image_id), 'status': status}
+            record.update(kwargs)
+            self.status[record['id']] = status
+            lines.append(json.dumps(record) + '\n')
+        self.fout.write(''.join(lines))
+        self.fout.flush()
+
+    def close(self):
+        self.fout.close()
+
+
+class PackedShards(object):
+    # All shards of a directory, loaded lazily
+
+    def __init__(self, root):
+        self.paths = list_shards(root)
+        self.shards = [None] * len(self.paths)
+
+    def shard(self, index):
+        if self.shards[index] is None:
+            self.shards[index] = load_shard(self.paths[index])
+        return self.shards[index]
+
+    def entries(self):
+        # (shard index, position, label, id) of every stored image
+        for shard_index in range(len(self.paths)):
+            shard = self.shard(shard_index)
+            for position, (label, image_id) in enumerate(zip(shard['labels'], shard['ids'])):
+                yield shard_index, position, label, image_id
+
+    def image(self, shard_index, position):
+        return self.shard(shard_index)['images'][position]
+
+
+class ShardItem(object):
+    def __init__(self, shards: PackedShards, shard_index, position):
+        self.shards = shards
+        self.shard_index = shard_index
+        self.position = position
+
+    def load(self):
+        # uint8, normalized after the batch is gathered
+        return self.shards.image(self.shard_index, self.position)
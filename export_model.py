@@ -0,0 +1,38 @@
+import argparse
+import os
+
+# noinspection PyUnresolvedReferences
+from inference.inference_config import *
+from models.images.classification.few_shot_learning.artifacts import load_model_artifact
+from models.images.classification.few_shot_learning.export import export_torchscript, export_onnx
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export trained few-shot model for inference.')
+
+    model_group = parser.add_mutually_exclusive_group(required=True)
+    model_group.add_argument('--model_name', type=str, choices=NAME2FOLDER.keys(), help='Name of the model')
+    model_group.add_argument('--model_folder', type=str, help='Path to session folder of the model')
+
+    parser.add_argument('--output_file', type=str, help='Path to TorchScript file', default='model.torchscript.pt')
+    parser.add_argument('--onnx_file', type=str, help='Also export ONNX graphs to this path', default=None)
+    parser.add_argument('--image_size', type=int, help='Size of input images for ONNX export (default = 84)',
+                        default=84)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    model_folder = args.model_folder if args.model_folder is not None else NAME2FOLDER[args.model_name]
+    model, info = load_model_artifact(model_folder, device=torch.device('cpu'))
+    model.eval()
+
+    export_torchscript(model, args.output_file)
+    print("TorchScript model saved to %s" % os.path.abspath(args.output_file))
+
+    if args.onnx_file is not None:
+        export_onnx(model, args.onnx_file, args.image_size)
+        print("ONNX model saved to %s" % os.path.abspath(args.onnx_file))
@@ -1,29 +1,120 @@
+import json
+import math
 import os
-
-import pandas as pd
+import threading
 
 INDEX_PATH = r"D:\petrtsv\projects\ds\torch-nn-project\index.csv"
+# Append-only store: one JSON record per line, columns are resolved on read
+HISTORY_PATH = os.path.splitext(INDEX_PATH)[0] + '.jsonl'
 NAME_COL = 'Name'
 
-index_df = None
+_lock = threading.Lock()
+_records = []
+_records_path = None
+_records_offset = 0
 
 
-def save_df():
-    index_df.to_csv(INDEX_PATH)
+def _to_json(value):
+    # numpy and torch scalars
+    try:
+        return value.item()
+    except (AttributeError, ValueError, RuntimeError):
+        return str(value)
 
 
-if os.path.exists(INDEX_PATH):
-    index_df = pd.read_csv(INDEX_PATH, index_col=0)
-else:
-    index_df = pd.DataFrame([{NAME_COL: 'Null', 'Explanation': 'To make data frame not empty'}])
-    save_df()
+def _encode(record):
+    return json.dumps(record, default=_to_json, ensure_ascii=False) + '\n'
 
 
 def save_record(name, **kwargs):
-    kwargs[NAME_COL] = name
-    record_df = pd.DataFrame([kwargs])
+    record = {NAME_COL: name}
+    record.update(kwargs)
+    line = _encode(record)
+    with _lock:
+        with open(HISTORY_PATH, 'a', encoding='utf-8') as fout:
+            fout.write(line)
+
+
+def load_records(path=None):
+    # Records appended since the previous call are read incrementally, the rest is served from memory
+    global _records, _records_path, _records_offset
+    path = HISTORY_PATH if path is None else path
+    with _lock:
+        if path != _records_path:
+            _records, _records_path, _records_offset = [], path, 0
+        if not os.path.exists(path):
+            return list(_records)
+        if os.path.getsize(path) < _records_offset:
+            # the file was replaced
+            _records, _records_offset = [], 0
+
+        with open(path, 'rb') as fin:
+            fin.seek(_records_offset)
+            for line in fin:
+                if not line.endswith(b'\n'):
+                    # incomplete record of a concurrent writer
+                    break
+                _records_offset += len(line)
+                line = line.strip()
+                if line:
+                    _records.append(json.loads(line.decode('utf-8')))
+        return list(_records)
+
+
+def _matches(record, filters):
+    for key, value in filters.items():
+        if callable(value):
+            if not value(record.get(key)):
+                return False
+        elif isinstance(value, (list, tuple, set)):
+            if record.get(key) not in value:
+                return False
+        elif record.get(key) != value:
+            return False
+    return True
+
+
+def query_records(path=None, **filters):
+    # filters: column=value, column=(value1, value2, ...) or column=predicate
+    return [record for record in load_records(path) if _matches(record, filters)]
+
+
+def query(columns=None, path=None, **filters):
+    import pandas as pd
+
+    df = pd.DataFrame(query_records(path, **filters))
+    if columns is not None:
+        df = df.reindex(columns=columns)
+    return df
+
+
+def import_csv(csv_path=INDEX_PATH, path=None):
+    # one-time migration of the old index.csv, skipped if the history already has records.
+    # -> number of imported records
+    import pandas as pd
+
+    path = HISTORY_PATH if path is None else path
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        return 0
+    index_df = pd.read_csv(csv_path, index_col=0)
+    lines = []
+    for row in index_df.to_dict(orient='records'):
+        if row.get(NAME_COL) == 'Null':
+            continue
+        record = {key: value for key, value in row.items()
+                  if not (isinstance(value, float) and math.isnan(value))}
+        lines.append(_encode(record))
+    # an interrupted import leaves no partial history behind
+    tmp_path = path + '.tmp'
+    with _lock:
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            fout.writelines(lines)
+        os.replace(tmp_path, path)
+    return len(lines)
 
-    global index_df
-    index_df = index_df.append(record_df, sort=False, ignore_index=True)
 
-    save_df()
+if __name__ == '__main__':
+    if os.path.exists(HISTORY_PATH) and os.path.getsize(HISTORY_PATH) > 0:
+        print("%s already has records, nothing imported" % HISTORY_PATH)
+    else:
+        print("%d records imported from %s to %s" % (import_csv(), INDEX_PATH, HISTORY_PATH))
@@ -0,0 +1,35 @@
+import torch
+import torch.nn.functional as F
+
+
+# Runs models exported by export_model.py; needs only torch, not the training code
+class ExportedModel(object):
+    def __init__(self, path, device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")):
+        self.device = device
+        self.module = torch.jit.load(path, map_location=device)
+        self.module.eval()
+        self.prototypes = None
+
+    def fit(self, support_set: torch.Tensor):
+        with torch.no_grad():
+            self.prototypes = self.module.fit(support_set.to(self.device))
+
+    def transform(self, x: torch.Tensor, top_k: int = None):
+        x = x.to(self.device)
+
+        if len(x.size()) == 3:
+            x = torch.unsqueeze(x, 0)
+
+        with torch.no_grad():
+            prob = self.module(self.prototypes, x)
+
+        if top_k is not None:
+            prob, classes = prob.topk(min(top_k, prob.size(1)), dim=1)
+            if prob.size(0) == 1:
+                prob = torch.squeeze(prob, 0)
+                classes = torch.squeeze(classes, 0)
+            return prob, classes
+
+        if prob.size(0) == 1:
+            prob = torch.squeeze(prob, 0)
+        return prob
@@ -18,3 +18,9 @@ NAME2FOLDER = {
     'random':
         r'D:\petrtsv\projects\ds\pytorch-sessions\RANDOM\RANDOM_203154-58-22-18-18-07-2020',
 }
+
+# Models kept in memory by inference_utils.MODEL_REGISTRY
+MODEL_CACHE_BUDGET = 2 * 1024 ** 3  # bytes of parameters and buffers
+PINNED_MODELS = (
+    'dfmn-landmarks-1shot-84x84',
+)
@@ -1,37 +1,144 @@
-# noinspection PyUnresolvedReferences
-import json
-import os
+import copy
+import threading
+import time
+from collections import OrderedDict
 
 import torch
+from torch import nn
 
-from inference.inference_config import NAME2FOLDER
+from inference.inference_config import NAME2FOLDER, MODEL_CACHE_BUDGET, PINNED_MODELS
 from models.images.classification.few_shot_learning import FitTransformFewShotLearningSolution
+from models.images.classification.few_shot_learning.artifacts import load_model_artifact
+from utils import pretty_time
 
 
-def get_model(model_name):
-    if model_name not in NAME2FOLDER:
-        return None
-    model_folder = NAME2FOLDER[model_name]
-    model_file = os.path.join(model_folder, 'output', 'trained_model_state_dict.tar')
-    model = torch.load(model_file)
-    model.eval()
+def model_size(model: nn.Module) -> int:
+    size = sum(p.numel() * p.element_size() for p in model.parameters())
+    size += sum(b.numel() * b.element_size() for b in model.buffers())
+    return size
+
+
+class ModelRegistry(object):
+    def __init__(self, budget=MODEL_CACHE_BUDGET, pinned=PINNED_MODELS):
+        self.budget = budget
+        self.pinned = set(pinned)
+        self.models = OrderedDict()  # name -> (model, info, size), least recently used first
+        self.loading = {}  # name -> threading.Event of a load in progress
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def __contains__(self, model_name):
+        return model_name in self.models
+
+    def resident_size(self):
+        return sum(size for _, _, size in self.models.values())
+
+    def get(self, model_name):
+        if model_name not in NAME2FOLDER:
+            return None, None
+
+        # models are loaded outside the lock, hits of other models do not wait for a cold load;
+        # concurrent requests of a model that is being loaded wait for that load
+        while True:
+            with self.lock:
+                if model_name in self.models:
+                    self.hits += 1
+                    self.models.move_to_end(model_name)
+                    model, info, _ = self.models[model_name]
+                    return model, info
+                loaded = self.loading.get(model_name)
+                if loaded is None:
+                    loaded = self.loading[model_name] = threading.Event()
+                    self.misses += 1
+                    break
+            # if that load fails, the next iteration loads it again
+            loaded.wait()
+
+        try:
+            start_time = time.time()
+            model, info = load_model_artifact(NAME2FOLDER[model_name])
+            model.eval()
+            size = model_size(model)
+            with self.lock:
+                self.load_time += time.time() - start_time
+                self.models[model_name] = (model, info, size)
+                self.evict(keep=model_name)
+        finally:
+            with self.lock:
+                del self.loading[model_name]
+            loaded.set()
+        return model, info
 
-    info_file = os.path.join(model_folder, 'output', 'info.json')
-    with open(info_file) as fin:
-        info = json.load(fin)
+    def evict(self, keep=None):
+        for name in list(self.models.keys()):
+            if self.resident_size() <= self.budget:
+                break
+            if name == keep or name in self.pinned:
+                continue
+            del self.models[name]
+            self.evictions += 1
 
-    return model, info
+    def pin(self, model_name):
+        with self.lock:
+            self.pinned.add(model_name)
+
+    def unpin(self, model_name):
+        # evict() reads pinned under the lock
+        with self.lock:
+            self.pinned.discard(model_name)
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+    def stats(self):
+        with self.lock:
+            loads = self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_time': self.load_time,
+                'average_load_time': self.load_time / loads if loads else 0.0,
+                'resident_models': list(self.models.keys()),
+                'resident_size': self.resident_size(),
+                'budget': self.budget,
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print("Models: %s (%.1f / %.1f MB)" % (', '.join(stats['resident_models']), stats['resident_size'] / 2 ** 20,
+                                               stats['budget'] / 2 ** 20))
+        print("Hits: %d\tMisses: %d\tEvictions: %d\tAverage load time: %s" % (
+            stats['hits'], stats['misses'], stats['evictions'], pretty_time(stats['average_load_time'])))
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_model(model_name):
+    return MODEL_REGISTRY.get(model_name)
 
 
 def fit_model(model_name: str, task: torch.Tensor):
     model, _ = get_model(model_name)
     if model is None or not isinstance(model, FitTransformFewShotLearningSolution):
         raise NotImplementedError('Model "%s" not found or can not be applied' % model_name)
+    # shallow copy shares weights with the cached model but keeps the fitted support set per call
+    model = copy.copy(model)
     model.fit(task)
     return model
 
 
-def apply_model(model: FitTransformFewShotLearningSolution, query: torch.Tensor):
-    result = model.transform(query)
+def apply_model(model: FitTransformFewShotLearningSolution, query: torch.Tensor, top_k: int = None):
+    if top_k is None:
+        result = model.transform(query)
+    else:
+        result = model.transform(query, top_k=top_k)
 
     return result
@@ -21,15 +21,52 @@ class FewShotLearningSolution(nn.Module):
     def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
+    def artifact_config(self) -> dict:
+        return {}
+
+
+class FittedState(object):
+    # Support set of a fit/transform model. It is kept out of the module attributes touched by forward(),
+    # so episodes do not leave activations behind and are not pickled or deep copied with the model.
+
+    def __init__(self, class_prototypes: torch.Tensor = None, class_sizes: list = None):
+        self.class_prototypes = class_prototypes
+        self.class_sizes = [] if class_sizes is None else class_sizes
+        self.prototype_index = None
+
+    @property
+    def n_classes(self):
+        return len(self.class_sizes)
+
 
 class FitTransformFewShotLearningSolution(FewShotLearningSolution):
+    def __init__(self):
+        super(FitTransformFewShotLearningSolution, self).__init__()
+        self.fitted_state = None
+
     def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
+    def fit_state(self, support_set: torch.Tensor) -> FittedState:
+        raise NotImplementedError
+
     def fit(self, support_set: torch.Tensor):
+        self.fitted_state = self.fit_state(support_set)
+
+    def transform(self, x: torch.Tensor, top_k: int = None, state: FittedState = None):
+        # returns class probabilities or, with top_k, a (probabilities, classes) pair of the top_k classes;
+        # uses the state of the last fit() unless state is given
+        raise NotImplementedError
+
+    # Incremental updates of a fitted support set, images are (n_images, channels, height, width)
+
+    def add_class(self, images: torch.Tensor) -> int:
+        raise NotImplementedError
+
+    def add_shots(self, class_index: int, images: torch.Tensor):
         raise NotImplementedError
 
-    def transform(self, x: torch.Tensor):
+    def remove_class(self, class_index: int):
         raise NotImplementedError
 
 
@@ -37,13 +74,6 @@ class ProtoNetBasedFSLSolution(FewShotLearningSolution):
     def __init__(self):
         super(ProtoNetBasedFSLSolution, self).__init__()
 
-        self.n_classes = None
-        self.support_set_size = None
-        self.support_set_features = None
-        self.class_prototypes = None
-        self.query_set_features = None
-        self.query_set_size = None
-
     def extract_features(self, batch: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
@@ -51,22 +81,19 @@ class ProtoNetBasedFSLSolution(FewShotLearningSolution):
         raise NotImplementedError
 
     def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
-        self.n_classes = support_set.size(0)
-        self.support_set_size = support_set.size(1)
-        self.query_set_size = query_set.size(0)
+        n_classes = support_set.size(0)
+        support_set_size = support_set.size(1)
+        query_set_size = query_set.size(0)
 
-        self.support_set_features = self.extract_features(remove_dim(support_set, 1)).view(self.n_classes,
-                                                                                           self.support_set_size, -1)
+        support_set_features = self.extract_features(remove_dim(support_set, 1)).view(n_classes, support_set_size, -1)
 
-        self.query_set_features = self.extract_features(query_set)
+        query_set_features = self.extract_features(query_set)
 
-        self.class_prototypes = self.get_prototypes(self.support_set_features, self.query_set_features)
+        class_prototypes = self.get_prototypes(support_set_features, query_set_features)
 
-        query_set_features_prepared = self.query_set_features.unsqueeze(1).repeat_interleave(repeats=self.n_classes,
-                                                                                             dim=1)
+        query_set_features_prepared = query_set_features.unsqueeze(1).repeat_interleave(repeats=n_classes, dim=1)
 
-        distance = torch.sum((self.class_prototypes.unsqueeze(0).repeat_interleave(repeats=self.query_set_size,
-                                                                                   dim=0) -
+        distance = torch.sum((class_prototypes.unsqueeze(0).repeat_interleave(repeats=query_set_size, dim=0) -
                               query_set_features_prepared).pow(2), dim=2)
 
         return -distance
@@ -119,6 +146,7 @@ class FSLEpisodeSampler(Dataset):
         support_set_labels = support_subdataset.labels()
 
         support_set = [[] for i in range(len(support_set_labels))]
+        support_is_test = [[] for i in range(len(support_set_labels))]
 
         h = 0
         for label in support_set_labels:
@@ -126,8 +154,9 @@ class FSLEpisodeSampler(Dataset):
             h += 1
 
         for i in range(len(support_subdataset)):
-            item, label, _ = support_subdataset[i]
+            item, label, is_test = support_subdataset[i]
             support_set[classes_mapping[label]].append(item.to(self.device))
+            support_is_test[classes_mapping[label]].append(is_test)
         if not self.balanced:
             batch = query_subdataset.random_batch(self.batch_size)
         else:
@@ -138,7 +167,7 @@ class FSLEpisodeSampler(Dataset):
 
         for i in range(len(support_set)):
             support_set[i] = torch.stack(support_set[i])
-        support_set = torch.stack(support_set)
+        support_set = self.subdataset.prepare_batch(torch.stack(support_set), support_is_test)
 
         return support_set, batch
 
@@ -152,6 +181,7 @@ class FSLEpisodeSamplerGlobalLabels(FSLEpisodeSampler):
         support_set_labels = support_subdataset.labels()
 
         support_set = [[] for i in range(len(support_set_labels))]
+        support_is_test = [[] for i in range(len(support_set_labels))]
 
         h = 0
         for label in support_set_labels:
@@ -159,8 +189,9 @@ class FSLEpisodeSamplerGlobalLabels(FSLEpisodeSampler):
             h += 1
 
         for i in range(len(support_subdataset)):
-            item, label, _ = support_subdataset[i]
+            item, label, is_test = support_subdataset[i]
             support_set[classes_mapping[label]].append(item.to(self.device))
+            support_is_test[classes_mapping[label]].append(is_test)
         if not self.balanced:
             batch = list(query_dataset.random_batch(self.batch_size))
         else:
@@ -174,7 +205,7 @@ class FSLEpisodeSamplerGlobalLabels(FSLEpisodeSampler):
 
         for i in range(len(support_set)):
             support_set[i] = torch.stack(support_set[i])
-        support_set = torch.stack(support_set)
+        support_set = self.subdataset.prepare_batch(torch.stack(support_set), support_is_test)
 
         return support_set, batch, classes_mapping
 
@@ -0,0 +1,125 @@
+import importlib
+import json
+import os
+import pickle
+
+import torch
+from torch import nn
+
+from models.images.classification.few_shot_learning import FEATURE_EXTRACTORS
+
+# Artifact layout: architecture config in info.json['artifact'] + state dict in a separate weights file.
+# Increase the version when the layout of info.json['artifact'] changes incompatibly.
+ARTIFACT_VERSION = 1
+
+INFO_FILE = "info.json"
+LEGACY_MODEL_FILE = "trained_model_state_dict.tar"
+WEIGHTS_FILE = "trained_model_weights.pt"
+SAFETENSORS_WEIGHTS_FILE = "trained_model_weights.safetensors"
+# fitted state that is not in the state dict (e.g. a fitted sklearn PCA), written only if the model has some
+EXTRA_STATE_FILE = "trained_model_extra_state.pkl"
+
+# Model class name -> module, imported only when a model of this class is loaded
+MODEL_MODULES = {
+    'MCTDFMN': 'models.images.classification.few_shot_learning.mctdfmn',
+    'ProtoNet': 'models.images.classification.few_shot_learning.protonet',
+    'TripletNet': 'models.images.classification.few_shot_learning.triplet',
+    'RandomClassifier': 'models.images.classification.few_shot_learning.dummy',
+    'EPNet': 'models.images.classification.few_shot_learning.epnet',
+    'ProtoNet_AE': 'models.images.classification.few_shot_learning.protonet_ae',
+    'ProtoNet_MHLNBS': 'models.images.classification.few_shot_learning.protonet_mhlnbs',
+}
+
+
+def save_model_artifact(model: nn.Module, output_dir: str, backbone_name: str = None, use_safetensors=False) -> dict:
+    model_class = type(model).__name__
+    if model_class not in MODEL_MODULES:
+        raise ValueError("Model class '%s' is not registered in MODEL_MODULES" % model_class)
+    if backbone_name is not None and backbone_name not in FEATURE_EXTRACTORS:
+        raise ValueError("Unknown backbone '%s'" % backbone_name)
+
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+    if use_safetensors:
+        from safetensors.torch import save_file
+        weights_file = SAFETENSORS_WEIGHTS_FILE
+        save_file(state_dict, os.path.join(output_dir, weights_file))
+    else:
+        weights_file = WEIGHTS_FILE
+        torch.save(state_dict, os.path.join(output_dir, weights_file))
+
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'model_class': model_class,
+        'backbone': backbone_name,
+        'model_kwargs': model.artifact_config(),
+        'weights_file': weights_file,
+    }
+
+    extra_state = model.artifact_extra_state() if hasattr(model, 'artifact_extra_state') else None
+    if extra_state:
+        with open(os.path.join(output_dir, EXTRA_STATE_FILE), 'wb') as fout:
+            pickle.dump(extra_state, fout)
+        artifact['extra_state_file'] = EXTRA_STATE_FILE
+    return artifact
+
+
+def load_state_dict_file(path: str) -> dict:
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 has no mmap/weights_only arguments
+        return torch.load(path, map_location='cpu')
+
+
+def build_model(artifact: dict) -> nn.Module:
+    version = artifact.get('version', 0)
+    if version > ARTIFACT_VERSION:
+        raise ValueError("Model artifact version %d is newer than supported version %d" % (version, ARTIFACT_VERSION))
+
+    model_class = artifact['model_class']
+    if model_class not in MODEL_MODULES:
+        raise ValueError("Unknown model class '%s'" % model_class)
+    model_cls = getattr(importlib.import_module(MODEL_MODULES[model_class]), model_class)
+
+    kwargs = dict(artifact['model_kwargs'])
+    if artifact['backbone'] is not None:
+        kwargs['backbone'] = FEATURE_EXTRACTORS[artifact['backbone']]()
+    return model_cls(**kwargs)
+
+
+def set_device(model: nn.Module, device) -> nn.Module:
+    # models that create tensors on self.device (MCTDFMN.fit_state, transform) do not follow model.to()
+    if hasattr(model, 'device'):
+        model.device = device
+    return model
+
+
+def load_model_artifact(model_folder: str,
+                        device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")):
+    output_dir = os.path.join(model_folder, 'output')
+    with open(os.path.join(output_dir, INFO_FILE)) as fin:
+        info = json.load(fin)
+
+    artifact = info.get('artifact')
+    if artifact is None:
+        # Old sessions pickled the whole module
+        try:
+            model = torch.load(os.path.join(output_dir, LEGACY_MODEL_FILE), map_location=device, weights_only=False)
+        except TypeError:
+            model = torch.load(os.path.join(output_dir, LEGACY_MODEL_FILE), map_location=device)
+        return set_device(model, device), info
+
+    model = build_model(artifact)
+    state_dict = load_state_dict_file(os.path.join(output_dir, artifact['weights_file']))
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # torch < 2.1 can not reuse the loaded (memory-mapped) storages
+        model.load_state_dict(state_dict)
+    if artifact.get('extra_state_file') is not None:
+        with open(os.path.join(output_dir, artifact['extra_state_file']), 'rb') as fin:
+            model.load_artifact_extra_state(pickle.load(fin))
+    return set_device(model.to(device), device), info
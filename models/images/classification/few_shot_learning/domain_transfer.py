@@ -1,5 +1,3 @@
-import json
-
 # noinspection PyUnresolvedReferences
 from models.images.classification.few_shot_learning.dummy import *
 # noinspection PyUnresolvedReferences
@@ -8,14 +6,13 @@ from models.images.classification.few_shot_learning.mctdfmn import *
 from models.images.classification.few_shot_learning.protonet import *
 # noinspection PyUnresolvedReferences
 from models.images.classification.few_shot_learning.triplet import *
+from models.images.classification.few_shot_learning.artifacts import load_model_artifact, save_model_artifact
 
 
 def change_dataset(model_folder: str, dataset_name: str, record: int, val_batch_size: int = None,
                    val_n_way: int = None, balanced_batches: bool = None):
-    model_file = os.path.join(model_folder, 'output', 'trained_model_state_dict.tar')
-    info_file = os.path.join(model_folder, 'output', 'info.json')
-    with open(info_file) as fin:
-        info = json.load(fin)
+    model, info = load_model_artifact(model_folder)
+    model.eval()
     print(info)
     if val_batch_size is not None:
         info['val_batch_size'] = val_batch_size
@@ -33,9 +30,6 @@ def change_dataset(model_folder: str, dataset_name: str, record: int, val_batch_
     if 'dataset' not in info:
         info['dataset'] = 'none'
 
-    model = torch.load(model_file)
-    model.eval()
-
     dataset = LABELED_DATASETS[dataset_name](augment_prob=0, image_size=info['image_size']).subdataset
     sampler = FSLEpisodeSampler(subdataset=dataset, n_way=info['n_way'], n_shot=info['n_shot'],
                                 batch_size=info['val_batch_size'],
@@ -53,7 +47,8 @@ def change_dataset(model_folder: str, dataset_name: str, record: int, val_batch_
     session.build(name=info['screen_name'] + '_transfer',
                   comment=r"Few-Shot Learning solution from '" + info['full_name'] + "'",
                   **info)
-    torch.save(model, os.path.join(session.data['output_dir'], "trained_model_state_dict.tar"))
+    backbone_name = info['artifact']['backbone'] if 'artifact' in info else info.get('feature_extractor')
+    session.data['artifact'] = save_model_artifact(model, session.data['output_dir'], backbone_name)
     session.save_info()
     # print(evaluate_solution(model, val_sampler, n_iterations=600))
 
@@ -1,32 +1,44 @@
-import os
-
 import torch
 import torch.nn.functional as F
 
-from models.images.classification.few_shot_learning import FitTransformFewShotLearningSolution
+from models.images.classification.few_shot_learning import FitTransformFewShotLearningSolution, FittedState
+from models.images.classification.few_shot_learning.artifacts import save_model_artifact
 from sessions import Session
 
 
 class RandomClassifier(FitTransformFewShotLearningSolution):
     def __init__(self):
         super().__init__()
-        self.n_classes = 1
-        self.n_query = 1
+        self.fitted_state = FittedState(class_sizes=[0])
 
     def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
-        self.n_classes = support_set.size(0)
-        self.n_query = query_set.size(0)
+        return F.softmax(torch.rand(query_set.size(0), support_set.size(0)), dim=1)
+
+    def fit_state(self, support_set: torch.Tensor) -> FittedState:
+        return FittedState(class_sizes=[support_set.size(1)] * support_set.size(0))
+
+    def add_class(self, images: torch.Tensor) -> int:
+        self.fitted_state.class_sizes.append(len(images))
+        return self.fitted_state.n_classes - 1
 
-        return F.softmax(torch.rand(self.n_query, self.n_classes), dim=1)
+    def add_shots(self, class_index: int, images: torch.Tensor):
+        self.fitted_state.class_sizes[class_index] += len(images)
 
-    def fit(self, support_set: torch.Tensor):
-        self.n_classes = support_set.size(0)
+    def remove_class(self, class_index: int):
+        self.fitted_state.class_sizes.pop(class_index)
 
-    def transform(self, x: torch.Tensor):
+    def transform(self, x: torch.Tensor, top_k: int = None, state: FittedState = None):
+        if state is None:
+            state = self.fitted_state
         if len(x.size()) == 3:
             x = torch.unsqueeze(x, 0)
-        self.n_query = x.size(0)
-        prob = F.softmax(torch.rand(self.n_query, self.n_classes), dim=1)
+        prob = F.softmax(torch.rand(x.size(0), state.n_classes), dim=1)
+        if top_k is not None:
+            prob, classes = prob.topk(min(top_k, state.n_classes), dim=1)
+            if prob.size(0) == 1:
+                prob = torch.squeeze(prob, 0)
+                classes = torch.squeeze(classes, 0)
+            return prob, classes
         if prob.size(0) == 1:
             prob = torch.squeeze(prob, 0)
         return prob
@@ -44,5 +56,5 @@ if __name__ == '__main__':
     session.build(name="RANDOM", comment=r"RANDOM classifier",
                   **session_info)
 
-    torch.save(best_model, os.path.join(session.data['output_dir'], "trained_model_state_dict.tar"))
+    session.data['artifact'] = save_model_artifact(best_model, session.data['output_dir'])
     session.save_info()
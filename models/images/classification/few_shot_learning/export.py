@@ -0,0 +1,130 @@
+import copy
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torchvision.models.resnet import BasicBlock, ResNet
+
+from models.images.classification.backbones import ResNetBlock
+from models.images.classification.few_shot_learning.mctdfmn import MCTDFMN, ScaleModule
+from models.images.classification.few_shot_learning.protonet import ProtoNet
+
+# (conv, batch norm) attribute pairs of blocks that apply the batch norm right after the convolution
+CONV_BN_PAIRS = {
+    ResNetBlock: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('convr', 'bnr')],
+    ScaleModule: [('conv', 'bn')],
+    BasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+    ResNet: [('conv1', 'bn1')],
+}
+
+
+def conv_bn_pairs(module: nn.Module):
+    if isinstance(module, nn.Sequential):
+        children = list(module.named_children())
+        return [(conv_name, bn_name) for (conv_name, conv), (bn_name, bn) in zip(children, children[1:])
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)]
+    return CONV_BN_PAIRS.get(type(module), [])
+
+
+def fold_batch_norms(model: nn.Module) -> nn.Module:
+    for module in list(model.modules()):
+        for conv_name, bn_name in conv_bn_pairs(module):
+            conv = getattr(module, conv_name)
+            bn = getattr(module, bn_name)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+    return model
+
+
+def remove_dropout(model: nn.Module) -> nn.Module:
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+    return model
+
+
+class FewShotInferenceModule(nn.Module):
+    # Stateless inference head: fit() maps a support set to prototype embeddings,
+    # forward() maps prototype embeddings and a query batch to class probabilities.
+
+    def __init__(self, feature_extractor: nn.Module, scale_module: nn.Module = None, normalize=False,
+                 extend_input=False):
+        super(FewShotInferenceModule, self).__init__()
+        self.feature_extractor = feature_extractor
+        self.scale_module = scale_module
+        self.normalize = normalize
+        self.extend_input = extend_input
+
+    def embed(self, features: torch.Tensor) -> torch.Tensor:
+        x = features.reshape(features.size(0), -1)
+        if self.normalize:
+            x = F.normalize(x, dim=1)
+        if self.scale_module is not None:
+            x = torch.div(x, self.scale_module(features))
+        return x
+
+    @torch.jit.export
+    def fit(self, support_set: torch.Tensor) -> torch.Tensor:
+        if self.extend_input:
+            support_set = torch.cat([support_set, torch.flip(support_set, [4])], dim=1)
+        n_classes = support_set.size(0)
+        support_set_size = support_set.size(1)
+
+        features = self.feature_extractor(support_set.reshape([n_classes * support_set_size] +
+                                                              list(support_set.shape[2:])))
+        features = features.reshape([n_classes, support_set_size] + list(features.shape[1:]))
+        return self.embed(torch.mean(features, dim=1))
+
+    def forward(self, prototypes: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
+        query_set = self.embed(self.feature_extractor(query_set))
+        distances = (query_set.unsqueeze(1) - prototypes.unsqueeze(0)).pow(2).sum(dim=2)
+        return F.softmax(-distances, dim=1)
+
+
+class _FitWrapper(nn.Module):
+    def __init__(self, module: FewShotInferenceModule):
+        super(_FitWrapper, self).__init__()
+        self.module = module
+
+    def forward(self, support_set: torch.Tensor) -> torch.Tensor:
+        return self.module.fit(support_set)
+
+
+def inference_module(model: nn.Module) -> FewShotInferenceModule:
+    model = copy.deepcopy(model).cpu().eval()
+    fold_batch_norms(model)
+    remove_dropout(model)
+
+    if isinstance(model, MCTDFMN):
+        scaling = not hasattr(model, 'scaling') or model.scaling
+        return FewShotInferenceModule(model.feature_extractor, scale_module=model.scale_module if scaling else None,
+                                      normalize=True, extend_input=getattr(model, 'extend_input', False)).eval()
+    if isinstance(model, ProtoNet):
+        return FewShotInferenceModule(model.feature_extractor).eval()
+    raise ValueError("Export is not supported for %s" % type(model).__name__)
+
+
+def export_torchscript(model: nn.Module, path: str):
+    module = torch.jit.script(inference_module(model))
+    module.save(path)
+    return module
+
+
+def export_onnx(model: nn.Module, path: str, image_size: int, n_way=5, n_shot=1, n_query=5):
+    # two graphs: <path> for forward(prototypes, query_set) and <path>.fit.onnx for fit(support_set)
+    module = inference_module(model)
+    support_set = torch.randn(n_way, n_shot, 3, image_size, image_size)
+    query_set = torch.randn(n_query, 3, image_size, image_size)
+    with torch.no_grad():
+        prototypes = module.fit(support_set)
+
+    torch.onnx.export(_FitWrapper(module), (support_set,), path + '.fit.onnx',
+                      input_names=['support_set'], output_names=['prototypes'],
+                      dynamic_axes={'support_set': {0: 'n_way', 1: 'n_shot'}, 'prototypes': {0: 'n_way'}})
+    torch.onnx.export(module, (prototypes, query_set), path,
+                      input_names=['prototypes', 'query_set'], output_names=['probabilities'],
+                      dynamic_axes={'prototypes': {0: 'n_way'}, 'query_set': {0: 'n_query'},
+                                    'probabilities': {0: 'n_query', 1: 'n_way'}})
@@ -14,11 +14,14 @@ from torch.optim.lr_scheduler import LambdaLR
 from data import LABELED_DATASETS, LabeledSubdataset
 from models.images.classification.backbones import NoFlatteningBackbone
 from models.images.classification.few_shot_learning import evaluate_solution_episodes, accuracy, FSLEpisodeSampler, \
-    FEATURE_EXTRACTORS, FSLEpisodeSamplerGlobalLabels, FitTransformFewShotLearningSolution
+    FEATURE_EXTRACTORS, FSLEpisodeSamplerGlobalLabels, FitTransformFewShotLearningSolution, FittedState
+from models.images.classification.few_shot_learning.artifacts import save_model_artifact
+from models.images.classification.few_shot_learning.prototype_index import IVFPrototypeIndex
 from sessions import Session
+from sessions.checkpoint import TrainingCheckpoint, StateDictSnapshot
 from torch_utils import flip_dimension
 from utils import pretty_time, remove_dim, inverse_mapping
-from visualization.plots import PlotterWindow
+from visualization.metrics import MetricsSink
 
 MAX_BATCH_SIZE = 500
 
@@ -60,12 +63,6 @@ class MCTDFMN(FitTransformFewShotLearningSolution):
                  pca=False, extend_input=False,
                  device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")):
         super(MCTDFMN, self).__init__()
-        self.n_classes = None
-        self.support_set_size = None
-        self.support_set_features = None
-        self.class_prototypes = None
-        self.query_set_features = None
-        self.query_set_size = None
         self.device = device
 
         self.scaling = scaling
@@ -116,41 +113,66 @@ class MCTDFMN(FitTransformFewShotLearningSolution):
         # print(x.size())
         return x
 
-    def build_prototypes(self, support_set: torch.Tensor, query_set: torch.Tensor = None):
+    def artifact_config(self) -> dict:
+        return {
+            'train_classes': self.train_classes,
+            'train_transduction_steps': self.train_ts,
+            'test_transduction_steps': self.test_ts,
+            'lmb': self.lmb,
+            'all_global_prototypes': self.all_global_prototypes,
+            # models pickled before these options existed have no such attributes
+            'scaling': getattr(self, 'scaling', True),
+            'pca': getattr(self, 'pca', False),
+            'extend_input': getattr(self, 'extend_input', False),
+        }
+
+    def artifact_extra_state(self) -> dict:
+        # the PCA is fitted outside of the state dict
+        pca_transformer = getattr(self, 'pca_transformer', None)
+        if pca_transformer is None or not hasattr(pca_transformer, 'components_'):
+            return {}
+        return {'pca_transformer': pca_transformer}
+
+    def load_artifact_extra_state(self, state: dict):
+        if 'pca_transformer' in state:
+            self.pca_transformer = state['pca_transformer']
+
+    def build_prototypes(self, support_set: torch.Tensor, query_set: torch.Tensor = None) -> torch.Tensor:
         its = self.train_ts if self.training else self.test_ts
-        self.class_prototypes = torch.mean(support_set, dim=1)
+        class_prototypes = torch.mean(support_set, dim=1)
         if query_set is not None:
             for i in range(its):
-                self.class_prototypes = self.update_prototypes(support_set, query_set)
+                class_prototypes = self.update_prototypes(support_set, query_set, class_prototypes)
+        return class_prototypes
 
-    def distance(self, a: torch.Tensor, b: torch.Tensor):
+    def embed(self, x: torch.Tensor):
+        # distance(a, b) is the squared l2 distance between embed(a) and embed(b)
         if not hasattr(self, 'scaling') or self.scaling:
-            a_scale = self.scale_module(a)
-            b_scale = self.scale_module(b)
+            x_scale = self.scale_module(x)
         else:
-            a_scale = 1
-            b_scale = 1
+            x_scale = 1
 
-        a = a.reshape(a.size(0), -1)
-        b = b.reshape(b.size(0), -1)
+        x = x.reshape(x.size(0), -1)
+        x = F.normalize(x, dim=1)
+        return torch.div(x, x_scale)
 
-        a = F.normalize(a, dim=1)
-        b = F.normalize(b, dim=1)
-        a = torch.div(a, a_scale)
-        b = torch.div(b, b_scale)
+    def distance(self, a: torch.Tensor, b: torch.Tensor):
+        a = self.embed(a)
+        b = self.embed(b)
         return (a - b).pow(2).sum(dim=1)
 
     def l2_distance(self, a: torch.Tensor, b: torch.Tensor):
         return (a - b).pow(2).sum(dim=1)
 
-    def get_proba(self, query_set: torch.Tensor):
-        return F.softmax(self.get_distances(query_set), dim=1)
+    def get_proba(self, query_set: torch.Tensor, class_prototypes: torch.Tensor):
+        return F.softmax(self.get_distances(query_set, class_prototypes), dim=1)
 
-    def get_distances(self, query_set: torch.Tensor):
-        query_set_expanded = query_set.repeat_interleave(self.n_classes, dim=0)
-        prototypes_expanded = self.class_prototypes.repeat(self.query_set_size, 1, 1, 1)
+    def get_distances(self, query_set: torch.Tensor, class_prototypes: torch.Tensor):
+        n_classes = class_prototypes.size(0)
+        query_set_expanded = query_set.repeat_interleave(n_classes, dim=0)
+        prototypes_expanded = class_prototypes.repeat(query_set.size(0), 1, 1, 1)
         distances = self.distance(query_set_expanded, prototypes_expanded)
-        distances = torch.stack(distances.split(self.n_classes))
+        distances = torch.stack(distances.split(n_classes))
         return -distances
 
     def get_l2_distances(self, query_set: torch.Tensor, prototypes: torch.Tensor):
@@ -163,12 +185,12 @@ class MCTDFMN(FitTransformFewShotLearningSolution):
         distances = torch.stack(distances.split(cur_n_classes))
         return -distances
 
-    def update_prototypes(self, support_set: torch.Tensor, query_set: torch.Tensor):
-        classes_denom = torch.tensor([self.support_set_size] * self.n_classes, device=query_set.device,
-                                     dtype=torch.float)
+    def update_prototypes(self, support_set: torch.Tensor, query_set: torch.Tensor, class_prototypes: torch.Tensor):
+        n_classes = support_set.size(0)
+        classes_denom = torch.tensor([support_set.size(1)] * n_classes, device=query_set.device, dtype=torch.float)
         new_proto = torch.sum(support_set, dim=1)
-        probas = self.get_proba(self.query_set_features)
-        for cur_class in range(self.n_classes):
+        probas = self.get_proba(query_set, class_prototypes)
+        for cur_class in range(n_classes):
             class_probas = probas[:, cur_class].squeeze()
             classes_denom[cur_class] += class_probas.sum()
             new_proto[cur_class] += torch.mul(query_set, class_probas.unsqueeze(1).unsqueeze(1).unsqueeze(1).expand_as(
@@ -176,81 +198,148 @@ class MCTDFMN(FitTransformFewShotLearningSolution):
         new_proto = torch.div(new_proto, classes_denom.unsqueeze(1).unsqueeze(1).unsqueeze(1).expand_as(new_proto))
         return new_proto
 
-    def apply_pca_transform(self):
-        prototypes_data = self.pca_transformer.fit_transform(self.class_prototypes.view(self.n_classes, -1).cpu())
-        query_set_data = self.pca_transformer.transform(self.query_set_features.view(self.query_set_size, -1).cpu())
-        self.class_prototypes = torch.from_numpy(prototypes_data).to(self.class_prototypes.device).view(self.n_classes,
-                                                                                                        -1, 1, 1)
-        self.query_set_features = torch.from_numpy(query_set_data).to(self.query_set_features.device).view(
-            self.query_set_size, -1, 1, 1)
-
-    def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
-        self.n_classes = support_set.size(0)
-
-        if self.extend_input:
+    def apply_pca_transform(self, class_prototypes: torch.Tensor, query_set: torch.Tensor):
+        n_classes = class_prototypes.size(0)
+        query_set_size = query_set.size(0)
+        prototypes_data = self.pca_transformer.fit_transform(class_prototypes.view(n_classes, -1).cpu())
+        query_set_data = self.pca_transformer.transform(query_set.view(query_set_size, -1).cpu())
+        class_prototypes = torch.from_numpy(prototypes_data).to(class_prototypes.device).view(n_classes, -1, 1, 1)
+        query_set = torch.from_numpy(query_set_data).to(query_set.device).view(query_set_size, -1, 1, 1)
+        return class_prototypes, query_set
+
+    def extract_support_set_features(self, support_set: torch.Tensor) -> torch.Tensor:
+        # (n_classes, support_set_size, ...) -> (n_classes, support_set_size, channels, featmap, featmap)
+        if getattr(self, 'extend_input', False):
             flipped_support_set = flip_dimension(support_set, 4)
 
             support_set = torch.cat([support_set, flipped_support_set], dim=1)
 
-        self.support_set_size = support_set.size(1)
-        self.query_set_size = query_set.size(0)
+        n_classes = support_set.size(0)
+        support_set_size = support_set.size(1)
 
-        self.support_set_features = self.extract_features(remove_dim(support_set, 1))
+        support_set_features = self.extract_features(remove_dim(support_set, 1))
 
-        self.support_set_features = self.support_set_features.view(
-            *([self.n_classes, self.support_set_size] + list(self.support_set_features.shape)[1:]))
+        return support_set_features.view(*([n_classes, support_set_size] + list(support_set_features.shape)[1:]))
 
-        self.query_set_features = self.extract_features(query_set)
+    def forward_episode(self, support_set: torch.Tensor, query_set: torch.Tensor):
+        # -> (negative distances, fitted state, query set features); nothing is stored on the module
+        support_set_features = self.extract_support_set_features(support_set)
+        query_set_features = self.extract_features(query_set)
 
-        self.build_prototypes(self.support_set_features, self.query_set_features)
+        class_prototypes = self.build_prototypes(support_set_features, query_set_features)
 
         if self.pca and not self.training:
-            self.apply_pca_transform()
-
-        return self.get_distances(self.query_set_features)
+            class_prototypes, query_set_features = self.apply_pca_transform(class_prototypes, query_set_features)
 
-    def fit(self, support_set: torch.Tensor):
-        self.n_classes = support_set.size(0)
+        state = FittedState(class_prototypes, [support_set_features.size(1)] * support_set_features.size(0))
+        return self.get_distances(query_set_features, class_prototypes), state, query_set_features
 
-        support_set = support_set.to(self.device)
+    def forward(self, support_set: torch.Tensor, query_set: torch.Tensor) -> torch.Tensor:
+        output, _, _ = self.forward_episode(support_set, query_set)
+        return output
 
-        try:
-            if self.extend_input:
-                flipped_support_set = flip_dimension(support_set, 4)
+    def fit_state(self, support_set: torch.Tensor) -> FittedState:
+        support_set_features = self.extract_support_set_features(support_set.to(self.device))
+        return FittedState(self.build_prototypes(support_set_features),
+                           [support_set_features.size(1)] * support_set_features.size(0))
 
-                support_set = torch.cat([support_set, flipped_support_set], dim=1)
-        except AttributeError:
-            pass
+    def extract_support_features(self, images: torch.Tensor) -> torch.Tensor:
+        images = images.to(self.device)
+        if len(images.size()) == 3:
+            images = torch.unsqueeze(images, 0)
 
-        self.support_set_size = support_set.size(1)
+        if getattr(self, 'extend_input', False):
+            images = torch.cat([images, flip_dimension(images, 3)])
 
-        self.support_set_features = self.extract_features(remove_dim(support_set, 1))
+        return self.extract_features(images)
 
-        self.support_set_features = self.support_set_features.view(
-            *([self.n_classes, self.support_set_size] + list(self.support_set_features.shape)[1:]))
+    @torch.no_grad()
+    def add_class(self, images: torch.Tensor) -> int:
+        features = self.extract_support_features(images)
+        prototype = torch.mean(features, dim=0, keepdim=True)
 
-        self.build_prototypes(self.support_set_features)
+        state = getattr(self, 'fitted_state', None)
+        if state is None or not state.n_classes:
+            self.fitted_state = state = FittedState(prototype, [])
+        else:
+            state.class_prototypes = torch.cat([state.class_prototypes, prototype])
+        state.class_sizes.append(features.size(0))
+        state.prototype_index = None
+
+        return state.n_classes - 1
+
+    @torch.no_grad()
+    def add_shots(self, class_index: int, images: torch.Tensor):
+        features = self.extract_support_features(images)
+        state = self.fitted_state
+
+        old_size = state.class_sizes[class_index]
+        new_size = old_size + features.size(0)
+        state.class_prototypes[class_index] = (state.class_prototypes[class_index] * old_size +
+                                               torch.sum(features, dim=0)) / new_size
+        state.class_sizes[class_index] = new_size
+        state.prototype_index = None
+
+    def remove_class(self, class_index: int):
+        # indices of the following classes are shifted by one
+        state = self.fitted_state
+        state.class_prototypes = torch.cat([state.class_prototypes[:class_index],
+                                            state.class_prototypes[class_index + 1:]])
+        state.class_sizes.pop(class_index)
+        state.prototype_index = None
+
+    @torch.no_grad()
+    def build_index(self, n_lists=None, n_probe=8):
+        state = self.fitted_state
+        state.prototype_index = IVFPrototypeIndex(n_lists=n_lists, n_probe=n_probe)
+        state.prototype_index.build(self.embed(state.class_prototypes))
+        return state.prototype_index
+
+    def transform(self, x: torch.Tensor, top_k: int = None, state: FittedState = None):
+        if top_k is not None:
+            return self.transform_top_k(x, top_k, state=state)
+        if state is None:
+            state = self.fitted_state
 
-    def transform(self, x: torch.Tensor):
         x = x.to(self.device)
 
         if len(x.size()) == 3:
             x = torch.unsqueeze(x, 0)
 
-        self.query_set_size = len(x)
-
-        self.query_set_features = self.extract_features(x)
-        y = self.get_distances(self.query_set_features)
+        y = self.get_distances(self.extract_features(x), state.class_prototypes)
         prob = F.softmax(y, dim=1)
         if prob.size(0) == 1:
             prob = torch.squeeze(prob, 0)
         return prob
 
+    @torch.no_grad()
+    def transform_top_k(self, x: torch.Tensor, k: int, state: FittedState = None):
+        if state is None:
+            state = self.fitted_state
+
+        x = x.to(self.device)
+
+        if len(x.size()) == 3:
+            x = torch.unsqueeze(x, 0)
+
+        query_set_features = self.extract_features(x)
+
+        if state.prototype_index is None:
+            prob = F.softmax(self.get_distances(query_set_features, state.class_prototypes), dim=1)
+            prob, classes = prob.topk(min(k, state.n_classes), dim=1)
+        else:
+            prob, classes = state.prototype_index.search_proba(self.embed(query_set_features), k)
+
+        if prob.size(0) == 1:
+            prob = torch.squeeze(prob, 0)
+            classes = torch.squeeze(classes, 0)
+        return prob, classes
+
     def forward_with_loss(self, support_set: torch.Tensor, query_set: torch.Tensor,
                           labels: torch.Tensor, global_classes_mapping: dict) -> Tuple[
         torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
 
-        output = self(support_set, query_set)
+        output, _, query_set_features = self.forward_episode(support_set, query_set)
         loss_i = self.loss_fn(output, labels)
 
         cur_labels = labels.clone().repeat_interleave(self.featmap_size2, dim=0)
@@ -268,9 +357,9 @@ class MCTDFMN(FitTransformFewShotLearningSolution):
         # print(cur_labels.size())
 
         expanded_global_prototypes = cur_global_prototypes
-        # expanded_query_set = torch.reshape(self.query_set_features, (self.query_set_features.size(0), -1))
-        # print(self.query_set_features.shape)
-        expanded_query_set = self.query_set_features.permute(0, 2, 3, 1).reshape((-1, self.query_set_features.size(1)))
+        # expanded_query_set = torch.reshape(query_set_features, (query_set_features.size(0), -1))
+        # print(query_set_features.shape)
+        expanded_query_set = query_set_features.permute(0, 2, 3, 1).reshape((-1, query_set_features.size(1)))
         # print(expanded_query_set.shape)
         # print(expanded_global_prototypes.shape)
         d_distances = self.get_l2_distances(expanded_query_set, expanded_global_prototypes)
@@ -298,6 +387,9 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
                   no_scaling=False,
                   pca=False,
                   extend_input=False,
+                  checkpoint_file=None,
+                  checkpoint_period=None,
+                  best_model_file=None,
                   device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"), **kwargs):
     session_info = {
         "task": "few-shot learning",
@@ -343,8 +435,8 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
     val_sampler = FSLEpisodeSampler(subdataset=val_subdataset, n_way=n_way, n_shot=n_shot, batch_size=val_batch_size,
                                     balanced=balanced_batches)
 
-    loss_plotter = PlotterWindow(interval=1000)
-    accuracy_plotter = PlotterWindow(interval=1000)
+    loss_plotter = MetricsSink('loss')
+    accuracy_plotter = MetricsSink('accuracy')
 
     loss_plotter.new_line('Loss')
     loss_plotter.new_line('Dense Loss')
@@ -359,18 +451,32 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
     acc_val = []
     val_iters = []
 
-    best_model = copy.deepcopy(model)
+    best_state = StateDictSnapshot(model, path=best_model_file)
 
     best_accuracy = 0
     best_iteration = -1
 
+    checkpoint = TrainingCheckpoint(checkpoint_file, checkpoint_period or eval_period, model=model, optimizer=optimizer,
+                                    scheduler=scheduler)
+    start_iteration, metrics = checkpoint.resume()
+    if metrics is not None:
+        losses = metrics['losses']
+        losses_d = metrics['losses_d']
+        losses_i = metrics['losses_i']
+        acc_train = metrics['acc_train']
+        acc_val = metrics['acc_val']
+        val_iters = metrics['val_iters']
+        best_accuracy = metrics['best_accuracy']
+        best_iteration = metrics['best_iteration']
+        best_state.load_state_dict(metrics['best_model'])
+
     print("Training started for parameters:")
     print(session_info)
     print()
 
     start_time = time.time()
 
-    for iteration in range(n_iterations):
+    for iteration in range(start_iteration, n_iterations):
         model.train()
 
         support_set, batch, global_classes_mapping = base_sampler.sample()
@@ -416,14 +522,14 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
             if val_accuracy > best_accuracy:
                 best_accuracy = val_accuracy
                 best_iteration = iteration
-                best_model = copy.deepcopy(model)
+                best_state.update(model)
                 print("Best evaluation result yet!")
 
             cur_time = time.time()
 
             val_time = cur_time - val_start_time
             time_used = cur_time - start_time
-            time_per_iteration = time_used / (iteration + 1)
+            time_per_iteration = time_used / (iteration + 1 - start_iteration)
 
             print()
             print("[%d/%d] = %.2f%%\t\tLoss: %.4f" % (
@@ -436,6 +542,16 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
             ))
             print()
 
+        checkpoint.step(iteration, losses=losses, losses_d=losses_d, losses_i=losses_i, acc_train=acc_train,
+                        acc_val=acc_val, val_iters=val_iters, best_accuracy=best_accuracy,
+                        best_iteration=best_iteration, best_model=best_state.state_dict())
+
+    checkpoint.close()
+    loss_plotter.close()
+    accuracy_plotter.close()
+    best_state.close()
+    model.load_state_dict(best_state.state_dict())
+
     cur_time = time.time()
     training_time = cur_time - start_time
     print("Training finished. Total execution time: %s" % pretty_time(training_time))
@@ -453,7 +569,7 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
     # session.data.update(session_info)
     # save_record(name="Few-Shot Learning Training: MCT + DFMN", **session_info)
 
-    torch.save(best_model, os.path.join(session.data['output_dir'], "trained_model_state_dict.tar"))
+    session.data['artifact'] = save_model_artifact(model, session.data['output_dir'], backbone_name)
     iters = list(range(1, n_iterations + 1))
 
     plt.figure(figsize=(20, 20))
@@ -470,7 +586,7 @@ def train_mctdfmn(base_subdataset: LabeledSubdataset, val_subdataset: LabeledSub
     plt.savefig(os.path.join(session.data['output_dir'], "acc_plot.png"))
 
     session.save_info()
-    return best_model
+    return model
 
 
 if __name__ == '__main__':
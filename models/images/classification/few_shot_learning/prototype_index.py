@@ -0,0 +1,98 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def kmeans(x: torch.Tensor, n_clusters: int, n_iterations: int):
+    centroids = x[torch.randperm(x.size(0), device=x.device)[:n_clusters]].clone()
+    assignments = None
+    for i in range(n_iterations):
+        assignments = torch.cdist(x, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=n_clusters)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1).to(x.dtype)
+    assignments = torch.cdist(x, centroids).argmin(dim=1)
+    return centroids, assignments
+
+
+class IVFPrototypeIndex(object):
+    # Inverted file index over prototype embeddings: queries are compared only with the prototypes
+    # of the n_probe nearest coarse centroids, i.e. about n_probe / n_lists of all classes.
+
+    def __init__(self, n_lists=None, n_probe=8, kmeans_iterations=10):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iterations = kmeans_iterations
+
+        self.embeddings = None
+        self.centroids = None
+        self.list_ids = None
+        self.list_offsets = None
+        self.list_sizes = None
+
+    def __len__(self):
+        return 0 if self.embeddings is None else self.embeddings.size(0)
+
+    def build(self, embeddings: torch.Tensor):
+        n_lists = self.n_lists
+        if n_lists is None:
+            n_lists = int(math.sqrt(embeddings.size(0)))
+        n_lists = max(1, min(n_lists, embeddings.size(0)))
+
+        centroids, assignments = kmeans(embeddings, n_lists, self.kmeans_iterations)
+
+        # embeddings are stored grouped by list, so every list is a contiguous slice
+        self.centroids = centroids
+        self.list_ids = torch.argsort(assignments)
+        self.embeddings = embeddings[self.list_ids]
+        counts = torch.bincount(assignments, minlength=n_lists).tolist()
+        self.list_offsets = [0]
+        for count in counts:
+            self.list_offsets.append(self.list_offsets[-1] + count)
+        self.list_sizes = torch.tensor(counts, device=embeddings.device)
+
+        return self
+
+    def search(self, queries: torch.Tensor, k: int):
+        k = min(k, len(self))
+        n_probe = min(self.n_probe, self.centroids.size(0))
+        _, probed_lists = torch.cdist(queries, self.centroids).topk(n_probe, dim=1, largest=False)
+
+        # best k candidates from every probed list, the slot of a list is its probe rank
+        distances = torch.full((queries.size(0), n_probe * k), float('inf'), device=queries.device)
+        indices = torch.full((queries.size(0), n_probe * k), -1, dtype=torch.long, device=queries.device)
+        for j in torch.unique(probed_lists).tolist():
+            begin, end = self.list_offsets[j], self.list_offsets[j + 1]
+            if begin == end:
+                continue
+            rows, ranks = (probed_lists == j).nonzero(as_tuple=True)
+            list_distances = torch.cdist(queries[rows], self.embeddings[begin:end]).pow(2)
+
+            cur_k = min(k, end - begin)
+            top_distances, top_positions = list_distances.topk(cur_k, dim=1, largest=False)
+            slots = ranks.unsqueeze(1) * k + torch.arange(cur_k, device=queries.device)
+            distances[rows.unsqueeze(1), slots] = top_distances
+            indices[rows.unsqueeze(1), slots] = self.list_ids[begin + top_positions]
+
+        distances, positions = distances.topk(k, dim=1, largest=False)
+        indices = indices.gather(1, positions)
+
+        # queries whose probed lists hold fewer than k prototypes are searched exactly
+        short = self.list_sizes[probed_lists].sum(dim=1) < k
+        if short.any():
+            short_distances, short_positions = exact_search(self.embeddings, queries[short], k)
+            distances[short] = short_distances
+            indices[short] = self.list_ids[short_positions]
+        return distances, indices
+
+    def search_proba(self, queries: torch.Tensor, k: int):
+        # probabilities are renormalized over the retrieved classes only
+        distances, indices = self.search(queries, k)
+        return F.softmax(-distances, dim=1), indices
+
+
+def exact_search(embeddings: torch.Tensor, queries: torch.Tensor, k: int):
+    distances = torch.cdist(queries, embeddings).pow(2)
+    return distances.topk(min(k, embeddings.size(0)), dim=1, largest=False)
@@ -0,0 +1,138 @@
+import argparse
+import copy
+import random
+import time
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from data import LABELED_DATASETS, LabeledSubdataset
+from models.images.classification.backbones import ConvNet64Original, ResNet12NoFlatteningOriginal
+from models.images.classification.few_shot_learning import FSLEpisodeSampler, evaluate_solution_episodes
+from models.images.classification.few_shot_learning.artifacts import load_model_artifact
+from models.images.classification.few_shot_learning.export import export_torchscript, remove_dropout
+from utils import pretty_time
+
+QUANTIZABLE_BACKBONES = (ConvNet64Original, ResNet12NoFlatteningOriginal)
+
+CPU = torch.device('cpu')
+
+
+class QuantizedBackbone(nn.Module):
+    def __init__(self, module: nn.Module):
+        super(QuantizedBackbone, self).__init__()
+        self.module = module
+
+    def forward(self, x):
+        # dequantized outputs may be non-contiguous, models flatten features with view()
+        return self.module(x).contiguous()
+
+
+def calibration_batches(subdataset: LabeledSubdataset, n_batches=20, batch_size=50):
+    return [subdataset.random_batch(min(batch_size, len(subdataset)))[0] for _ in range(n_batches)]
+
+
+def quantize_backbone(backbone: nn.Module, batches, backend='fbgemm') -> nn.Module:
+    # FX graph mode: conv-bn-relu of conv_block and ResNetBlock (including the residual add-relu)
+    # are fused before observers are inserted
+    if not isinstance(backbone, QUANTIZABLE_BACKBONES):
+        raise ValueError("Quantization is not supported for %s" % type(backbone).__name__)
+    torch.backends.quantized.engine = backend
+
+    backbone = remove_dropout(copy.deepcopy(backbone).to(CPU).eval())
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(backend), (batches[0],))
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch.to(CPU))
+    return QuantizedBackbone(convert_fx(prepared))
+
+
+def quantize_model(model: nn.Module, batches, backend='fbgemm') -> nn.Module:
+    quantized = copy.deepcopy(model).to(CPU).eval()
+    quantized.feature_extractor = quantize_backbone(model.feature_extractor, batches, backend=backend)
+    if hasattr(quantized, 'device'):
+        quantized.device = CPU
+    return quantized
+
+
+def episodes_accuracy(model: nn.Module, subdataset: LabeledSubdataset, n_way, n_shot, batch_size, n_iterations,
+                      seed):
+    # the same seed gives the same episodes for every evaluated model
+    random.seed(seed)
+    torch.random.manual_seed(seed)
+    sampler = FSLEpisodeSampler(subdataset=subdataset, n_way=n_way, n_shot=n_shot, batch_size=batch_size,
+                                balanced=True, device=CPU)
+    return evaluate_solution_episodes(model, sampler, n_iterations=n_iterations, device=CPU)
+
+
+def backbone_latency(backbone: nn.Module, batch: torch.Tensor, repeats=10):
+    with torch.no_grad():
+        backbone(batch)
+        start_time = time.time()
+        for i in range(repeats):
+            backbone(batch)
+    return (time.time() - start_time) / repeats
+
+
+def compare_quantization(model: nn.Module, quantized: nn.Module, subdataset: LabeledSubdataset, n_way=5, n_shot=1,
+                         batch_size=5, n_iterations=600, seed=2002):
+    batch = subdataset.random_batch(n_way * (n_shot + batch_size))[0]
+    model = model.to(CPU).eval()
+    if hasattr(model, 'device'):
+        model.device = CPU
+
+    report = {}
+    for name, cur_model in (('fp32', model), ('int8', quantized)):
+        report[name + '_latency'] = backbone_latency(cur_model.feature_extractor, batch)
+        report[name + '_accuracy'] = episodes_accuracy(cur_model, subdataset, n_way, n_shot, batch_size,
+                                                       n_iterations, seed)
+    report['accuracy_delta'] = report['int8_accuracy'] - report['fp32_accuracy']
+    report['speedup'] = report['fp32_latency'] / report['int8_latency']
+
+    print("Accuracy: fp32 = %.4f\tint8 = %.4f\tdelta = %+.4f" % (
+        report['fp32_accuracy'], report['int8_accuracy'], report['accuracy_delta']))
+    print("Backbone latency (%d images): fp32 = %s\tint8 = %s\tspeedup = %.2fx" % (
+        batch.size(0), pretty_time(report['fp32_latency']), pretty_time(report['int8_latency']), report['speedup']))
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Post-training static int8 quantization of a few-shot model.')
+
+    parser.add_argument('model_folder', type=str, help='Path to session folder of the model')
+    parser.add_argument('--dataset', type=str, choices=LABELED_DATASETS.keys(), help='Calibration and evaluation dataset',
+                        required=True)
+    parser.add_argument('--base_classes', type=int, help='Number of base classes used for calibration, '
+                                                             'by default the one of the training session')
+    parser.add_argument('--output_file', type=str, help='Path to int8 TorchScript file', default='model.int8.pt')
+    parser.add_argument('--calibration_batches', type=int, default=20)
+    parser.add_argument('--n_way', type=int, default=5)
+    parser.add_argument('--n_shot', type=int, default=1)
+    parser.add_argument('--episodes', type=int, default=600)
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=('fbgemm', 'x86', 'qnnpack'))
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    model, info = load_model_artifact(args.model_folder, device=CPU)
+    model.eval()
+
+    dataset = LABELED_DATASETS[args.dataset](augment_prob=0, image_size=info.get('image_size', 84))
+    base_classes = args.base_classes if args.base_classes is not None else info['base_classes']
+    train_subdataset, test_subdataset = dataset.subdataset.extract_classes(base_classes)
+
+    print("Calibration...")
+    quantized_model = quantize_model(model, calibration_batches(train_subdataset, n_batches=args.calibration_batches),
+                                     backend=args.backend)
+
+    compare_quantization(model, quantized_model, test_subdataset, n_way=args.n_way, n_shot=args.n_shot,
+                         n_iterations=args.episodes)
+
+    export_torchscript(quantized_model, args.output_file)
+    print("int8 model saved to %s" % args.output_file)
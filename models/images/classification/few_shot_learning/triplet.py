@@ -12,9 +12,11 @@ from data import LABELED_DATASETS, LabeledSubdataset
 from models.images.classification.backbones import NoFlatteningBackbone
 from models.images.classification.few_shot_learning import evaluate_solution_episodes, FSLEpisodeSampler, \
     FEATURE_EXTRACTORS, OPTIMIZERS, TripletBatchSampler
+from models.images.classification.few_shot_learning.artifacts import save_model_artifact
 from sessions import Session
+from sessions.checkpoint import TrainingCheckpoint
 from utils import pretty_time, remove_dim
-from visualization.plots import PlotterWindow
+from visualization.metrics import MetricsSink
 
 MAX_BATCH_SIZE = 100
 
@@ -49,6 +51,9 @@ class TripletNet(nn.Module):
         x = torch.cat(xs)
         return x
 
+    def artifact_config(self) -> dict:
+        return {'alpha': self.alpha}
+
     def get_prototypes(self, support_set: torch.Tensor):
         return torch.mean(support_set, dim=1)
 
@@ -93,6 +98,8 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
                      balanced_batches: bool,
                      alpha=0.5,
                      backbone_name='resnet12-np-o',
+                     checkpoint_file=None,
+                     checkpoint_period=None,
                      device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"), **kwargs):
     session_info = {
         "task": "few-shot learning",
@@ -123,8 +130,8 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
     val_sampler = FSLEpisodeSampler(subdataset=val_subdataset, n_way=n_way, n_shot=n_shot, batch_size=val_batch_size,
                                     balanced=balanced_batches)
 
-    loss_plotter = PlotterWindow(interval=1000)
-    accuracy_plotter = PlotterWindow(interval=1000)
+    loss_plotter = MetricsSink('loss')
+    accuracy_plotter = MetricsSink('accuracy')
 
     loss_plotter.new_line('Loss')
     accuracy_plotter.new_line('Train Accuracy')
@@ -138,13 +145,23 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
     best_accuracy = 0
     best_iteration = -1
 
+    checkpoint = TrainingCheckpoint(checkpoint_file, checkpoint_period or eval_period, model=model, optimizer=optimizer)
+    start_iteration, metrics = checkpoint.resume()
+    if metrics is not None:
+        losses = metrics['losses']
+        acc_train = metrics['acc_train']
+        acc_val = metrics['acc_val']
+        val_iters = metrics['val_iters']
+        best_accuracy = metrics['best_accuracy']
+        best_iteration = metrics['best_iteration']
+
     print("Training started for parameters:")
     print(session_info)
     print()
 
     start_time = time.time()
 
-    for iteration in range(n_iterations):
+    for iteration in range(start_iteration, n_iterations):
         model.train()
         anchor, positive, negative = base_sampler.sample()
 
@@ -182,7 +199,7 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
 
             val_time = cur_time - val_start_time
             time_used = cur_time - start_time
-            time_per_iteration = time_used / (iteration + 1)
+            time_per_iteration = time_used / (iteration + 1 - start_iteration)
 
             print()
             print("[%d/%d] = %.2f%%\t\tLoss: %.4f" % (
@@ -195,6 +212,13 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
             ))
             print()
 
+        checkpoint.step(iteration, losses=losses, acc_train=acc_train, acc_val=acc_val, val_iters=val_iters,
+                        best_accuracy=best_accuracy, best_iteration=best_iteration)
+
+    checkpoint.close()
+    loss_plotter.close()
+    accuracy_plotter.close()
+
     cur_time = time.time()
     training_time = cur_time - start_time
     print("Training finished. Total execution time: %s" % pretty_time(training_time))
@@ -209,7 +233,7 @@ def train_tripletnet(base_subdataset: LabeledSubdataset, val_subdataset: Labeled
     session = Session()
     session.build(name="TripletNet", comment=r"Triplet loss",
                   **session_info)
-    torch.save(model, os.path.join(session.data['output_dir'], "trained_model_state_dict.tar"))
+    session.data['artifact'] = save_model_artifact(model, session.data['output_dir'], backbone_name)
     iters = list(range(1, n_iterations + 1))
 
     plt.figure(figsize=(20, 20))
@@ -1,18 +1,34 @@
 import argparse
+import os
 
 import torch
-from PIL import Image
-from torchvision import transforms
 
-from data.image_transforms import TO_RGB_TENSOR
+from data.preprocessing import images_to_tensor, list_images
+
+
+def parse_source(path):
+    if not os.path.exists(path):
+        msg = "'%s' not found" % path
+        raise argparse.ArgumentTypeError(msg)
+
+    if os.path.isdir(path):
+        files = list_images(path)
+        if not files:
+            msg = "'%s' has no images" % path
+            raise argparse.ArgumentTypeError(msg)
+        return files
+
+    return path
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='Convert image to tensor')
+    parser = argparse.ArgumentParser(description='Convert image or directory of images to tensor')
 
-    parser.add_argument('file', type=argparse.FileType('rb'), help='Path to file')
+    parser.add_argument('file', type=parse_source, help='Path to file or directory of query images')
     parser.add_argument('--output_file', type=argparse.FileType('wb'), help='Path to result file', default='query.pt')
     parser.add_argument('--image_resize', type=int, help='Size of scaled query (default = 84)', default=84)
+    parser.add_argument('--workers', type=int, help='Number of decoding processes (default = number of CPUs)',
+                        default=None)
 
     args = parser.parse_args()
     return args
@@ -22,14 +38,10 @@ if __name__ == '__main__':
     args = parse_args()
 
     source = args.file
-    resize_transform = transforms.Compose(
-        [transforms.Resize(args.image_resize), transforms.CenterCrop(args.image_resize)]
-    )
-
-    # with open(source, 'rb') as f:
-    img = Image.open(source)
-    img = img.convert('RGB')
-    img = resize_transform(img)
-    tensor = TO_RGB_TENSOR(img)
+    if isinstance(source, list):
+        tensor = images_to_tensor(source, args.image_resize, workers=args.workers)
+        print("%d queries" % tensor.size(0))
+    else:
+        tensor = images_to_tensor([source], args.image_resize, workers=1)[0]
 
     torch.save(tensor, args.output_file)
@@ -2,10 +2,8 @@ import argparse
 import os
 
 import torch
-from PIL import Image
-from torchvision import transforms
 
-from data.image_transforms import TO_RGB_TENSOR
+from data.preprocessing import images_to_tensor, list_images
 
 
 def parse_dir(path):
@@ -19,13 +17,8 @@ def parse_dir(path):
 
     data = []
 
-    for class_dir in [e.path for e in os.scandir(path) if e.is_dir()]:
-        data.append([])
-        for f in [e.path for e in os.scandir(class_dir) if e.is_file()]:
-            with open(f, 'rb') as inp:
-                image = Image.open(inp)
-                image = image.convert('RGB')
-            data[-1].append(image)
+    for class_dir in sorted(e.path for e in os.scandir(path) if e.is_dir()):
+        data.append(list_images(class_dir))
         if len(data[0]) != len(data[-1]):
             msg = "'%s' classes are not equal" % path
             raise argparse.ArgumentTypeError(msg)
@@ -43,6 +36,8 @@ def parse_args():
     parser.add_argument('folder', type=parse_dir, help='Path to dataset_folder')
     parser.add_argument('--output_file', type=argparse.FileType('wb'), help='Path to result file', default='query.pt')
     parser.add_argument('--image_resize', type=int, help='Size of scaled query (default = 84)', default=84)
+    parser.add_argument('--workers', type=int, help='Number of decoding processes (default = number of CPUs)',
+                        default=None)
 
     args = parser.parse_args()
     return args
@@ -52,16 +47,9 @@ if __name__ == '__main__':
     args = parse_args()
 
     data = args.folder
-    resize_transform = transforms.Compose(
-        [transforms.Resize(args.image_resize), transforms.CenterCrop(args.image_resize)]
-    )
-
-    for i in range(len(data)):
-        for j in range(len(data[i])):
-            img = data[i][j]
-            img = resize_transform(img)
-            data[i][j] = TO_RGB_TENSOR(img)
-        data[i] = torch.stack(data[i])
-    tensor = torch.stack(data)
+    n_way, n_shot = len(data), len(data[0])
+    files = [f for class_files in data for f in class_files]
+
+    tensor = images_to_tensor(files, args.image_resize, shape=(n_way, n_shot), workers=args.workers)
     print("%d classes, %d shots" % (tensor.size(0), tensor.size(1)))
     torch.save(tensor, args.output_file)
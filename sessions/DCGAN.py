@@ -9,6 +9,7 @@ import data.celeba
 from data.image_transforms import scaling_grayscale
 from models.images.generative.gan.dcgan import DCGANGenerator, DCGANDiscriminator
 from sessions import Session
+from sessions.checkpoint import latest_checkpoint, load_checkpoint
 from training import adversarial
 
 
@@ -90,7 +91,7 @@ class SimpleDCGAN(Session):
     def __restore__(self, data_file):
         super(SimpleDCGAN, self).__restore__(data_file)
         torch_state_file = os.path.join(self.data['checkpoint_dir'], 'torch_state.tar')
-        checkpoint = torch.load(torch_state_file)
+        checkpoint = load_checkpoint(latest_checkpoint(torch_state_file, self.keep_checkpoints))
 
         self.generator.load_state_dict(checkpoint['generator_state_dict'])
         self.generator.train()
@@ -106,7 +107,7 @@ class SimpleDCGAN(Session):
     def checkpoint(self):
         super(SimpleDCGAN, self).checkpoint()
         torch_state_file = os.path.join(self.data['checkpoint_dir'], 'torch_state.tar')
-        torch.save({
+        self.checkpoint_writer().save({
             'generator_state_dict': self.generator.state_dict(),
             'discriminator_state_dict': self.discriminator.state_dict(),
             'optimizer_g_state_dict': self.optimizer_g.state_dict(),
@@ -144,3 +145,4 @@ class SimpleDCGAN(Session):
         self.save_result(
             *self.training()
         )
+        self.close_checkpoints()
@@ -5,6 +5,7 @@ from copy import deepcopy
 from datetime import datetime
 
 from history.index import save_record
+from sessions.checkpoint import CheckpointWriter, pickle_dump
 
 os.environ['TORCH_HOME'] = "D:\\torch_home"
 
@@ -14,6 +15,7 @@ SESSION_FOLDER_PATTERN = "%s_%s"
 SESSION_CREATION_TIME_PATTERN = "%f-%S-%M-%H-%d-%m-%Y"
 
 CHECKPOINT_DIR = "checkpoint"
+CHECKPOINT_KEEP_LAST = 1
 OUTPUT_DIR = "output"
 
 
@@ -30,6 +32,8 @@ def is_jsonable(data):
 
 
 class Session(object):
+    keep_checkpoints = CHECKPOINT_KEEP_LAST
+    _checkpoint_writer = None
 
     def __create__(self, name, comment, **kwargs):
         if name is None:
@@ -64,9 +68,19 @@ class Session(object):
         with open(data_file, "rb") as fin:
             self.data = dict(pickle.load(fin))
 
+    def checkpoint_writer(self) -> CheckpointWriter:
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter(keep_last=self.keep_checkpoints)
+        return self._checkpoint_writer
+
     def checkpoint(self):
-        with open(os.path.join(self.data['checkpoint_dir'], "session_data.pickle"), "wb") as fout:
-            pickle.dump(self.data, fout)
+        self.checkpoint_writer().save(self.data, os.path.join(self.data['checkpoint_dir'], "session_data.pickle"),
+                                      save_fn=pickle_dump)
+
+    def close_checkpoints(self):
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
+            self._checkpoint_writer.print_stats()
 
     def build(self, name=None, comment="", state_file=None, **kwargs):
         if state_file is None:
@@ -0,0 +1,236 @@
+import atexit
+import copy
+import os
+import pickle
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+from utils import pretty_time
+
+
+def snapshot(obj):
+    # detached CPU copy of tensors (state dicts, optimizer states), deep copy of everything else
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rotated_path(path, index):
+    return path if index == 0 else "%s.%d" % (path, index)
+
+
+def atomic_save(obj, path, save_fn=torch.save, keep_last=1):
+    # the previous checkpoint stays valid until the new one is completely on disk
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        save_fn(obj, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    # path -> path.1 -> ... -> path.<keep_last - 1>
+    for i in range(keep_last - 1, 0, -1):
+        if os.path.exists(rotated_path(path, i - 1)):
+            os.replace(rotated_path(path, i - 1), rotated_path(path, i))
+    os.replace(tmp_path, path)
+
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def latest_checkpoint(path, keep_last=1):
+    # a crash between rotation and the final rename leaves only path.1
+    for i in range(max(keep_last, 2)):
+        if os.path.exists(rotated_path(path, i)):
+            return rotated_path(path, i)
+    raise FileNotFoundError(path)
+
+
+def pickle_dump(obj, fout):
+    pickle.dump(obj, fout)
+
+
+class CheckpointWriter(object):
+    # Writes checkpoints in a background thread. The caller blocks only for the CPU snapshot;
+    # with max_pending writes queued the next save waits for the disk.
+
+    def __init__(self, keep_last=1, max_pending=1):
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.written = 0
+        self.snapshot_time = 0.0
+        self.write_time = 0.0
+        self.last_write_time = 0.0
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                obj, path, save_fn = job
+                start_time = time.time()
+                atomic_save(obj, path, save_fn=save_fn, keep_last=self.keep_last)
+                self.last_write_time = time.time() - start_time
+                self.write_time += self.last_write_time
+                self.written += 1
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, path, save_fn=torch.save, copy=True):
+        # copy=False: obj is written as it is, the caller must not change it before wait() returns
+        self._raise_error()
+        if copy:
+            start_time = time.time()
+            obj = snapshot(obj)
+            self.snapshot_time += time.time() - start_time
+        self.queue.put((obj, path, save_fn))
+
+    def wait(self):
+        self.queue.join()
+        self._raise_error()
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'snapshot_time': self.snapshot_time,
+            'write_time': self.write_time,
+            'last_write_time': self.last_write_time,
+        }
+
+    def print_stats(self):
+        if self.written == 0:
+            return
+        print("Checkpoints: %d written, blocking snapshot %s per checkpoint, background write %s per checkpoint" % (
+            self.written, pretty_time(self.snapshot_time / self.written), pretty_time(self.write_time / self.written)))
+
+
+class StateDictSnapshot(object):
+    # Copy of a module state dict in CPU buffers that are allocated once and overwritten in place.
+    # Only the state dict is copied, tensors the module caches on itself are not.
+    # If path is given, every update is also written there in the background.
+
+    def __init__(self, module: torch.nn.Module, path=None):
+        self.buffers = {key: torch.empty(value.shape, dtype=value.dtype, pin_memory=value.is_cuda)
+                        for key, value in module.state_dict().items()}
+        self.path = path
+        self.writer = None if path is None else CheckpointWriter()
+        self.update(module)
+
+    def update(self, module: torch.nn.Module):
+        if self.writer is not None:
+            # the buffers are written without another copy, the previous write must be done before they change
+            self.writer.wait()
+        with torch.no_grad():
+            for key, value in module.state_dict().items():
+                self.buffers[key].copy_(value)
+        if self.writer is not None:
+            self.writer.save(self.buffers, self.path, copy=False)
+
+    def state_dict(self):
+        return self.buffers
+
+    def load_state_dict(self, state_dict):
+        if self.writer is not None:
+            self.writer.wait()
+        with torch.no_grad():
+            for key, value in state_dict.items():
+                self.buffers[key].copy_(value)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.wait()
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+class TrainingCheckpoint(object):
+    # Periodic checkpoint of an iteration loop: states of the given objects (model, optimizer, scheduler),
+    # RNG states and metric history. Saved after the last step of an iteration, so a resumed loop continues
+    # with exactly the same random numbers. The episode samplers keep no state of their own, they draw
+    # from the global random state, so the same episodes follow. Disabled if path is None.
+
+    def __init__(self, path=None, period=1000, keep_last=1, **objects):
+        self.path = path
+        self.period = period
+        self.keep_last = keep_last
+        self.objects = objects
+        self.writer = None if path is None else CheckpointWriter(keep_last=keep_last)
+
+    def resume(self):
+        # -> (first iteration to run, metrics saved with the checkpoint or None)
+        if self.path is None:
+            return 0, None
+        try:
+            path = latest_checkpoint(self.path, self.keep_last)
+        except FileNotFoundError:
+            return 0, None
+
+        state = load_checkpoint(path)
+        for name, obj in self.objects.items():
+            obj.load_state_dict(state['states'][name])
+        set_rng_state(state['rng'])
+        print("Training resumed from %s at iteration %d" % (path, state['iteration']))
+        return state['iteration'], state['metrics']
+
+    def step(self, iteration, **metrics):
+        if self.writer is None or (iteration + 1) % self.period != 0:
+            return
+        self.writer.save({
+            'iteration': iteration + 1,
+            'states': {name: obj.state_dict() for name, obj in self.objects.items()},
+            'rng': rng_state(),
+            'metrics': metrics,
+        }, self.path)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.wait()
+            self.writer.print_stats()
@@ -10,6 +10,7 @@ from data.gtsrb import GTSRBDataset
 from models.images.classification.transfer_learning import ResNet18Classifier, GoogLeNetClassifier, \
     ResNet18CosineClassifier
 from sessions import Session
+from sessions.checkpoint import latest_checkpoint, load_checkpoint, rng_state, set_rng_state
 from training import simple
 
 
@@ -51,6 +52,8 @@ class ClassifierSession(Session):
 
         self.optimizer = optimizer
 
+        self.metrics = None
+
         self.build(
             state_file=state_file,
             n_classes=n_classes,
@@ -65,19 +68,24 @@ class ClassifierSession(Session):
     def __restore__(self, data_file):
         super(ClassifierSession, self).__restore__(data_file)
         torch_state_file = os.path.join(self.data['checkpoint_dir'], 'torch_state.tar')
-        checkpoint = torch.load(torch_state_file)
+        checkpoint = load_checkpoint(latest_checkpoint(torch_state_file, self.keep_checkpoints))
 
         self.model.load_state_dict(checkpoint['model_state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         self.loss.load_state_dict(checkpoint['loss_state_dict'])
+        self.metrics = checkpoint.get('metrics')
+        if 'rng_state' in checkpoint:
+            set_rng_state(checkpoint['rng_state'])
 
     def checkpoint(self):
         super(ClassifierSession, self).checkpoint()
         torch_state_file = os.path.join(self.data['checkpoint_dir'], 'torch_state.tar')
-        torch.save({
+        self.checkpoint_writer().save({
             'model_state_dict': self.model.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
             'loss_state_dict': self.loss.state_dict(),
+            'metrics': self.metrics,
+            'rng_state': rng_state(),
         }, torch_state_file)
 
     def training(self):
@@ -88,7 +96,7 @@ class ClassifierSession(Session):
                                        optimizer=self.optimizer,
                                        loss=self.loss,
                                        epochs=self.data['epochs'],
-                                       cur_epoch=0,
+                                       cur_epoch=self.data.get('cur_epoch', 0),
                                        n_classes=self.n_classes,
                                        eval_epoch_period=self.eval_period
                                        )
@@ -113,6 +121,7 @@ class ClassifierSession(Session):
         self.save_output(
             *self.training()
         )
+        self.close_checkpoints()
 
 
 class ResNet18GTSRB(ClassifierSession):
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from data.google_landmarks import load_from_index, GoogleLandmarksDatasetBase
+from data.shards import Manifest
+
+
+def stand_in_server(images, port=0, fail_first=1, missing=()):
+    # Local HTTP server for ingestion runs without network access: GET /<name> returns images[name],
+    # the first fail_first requests of every name get 503, names in missing get 404.
+    # -> (server, base url), stop with server.shutdown()
+    requests_count = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            name = self.path.lstrip('/')
+            with lock:
+                requests_count[name] = requests_count.get(name, 0) + 1
+                count = requests_count[name]
+            if name in missing or name not in images:
+                self.send_response(404)
+                body = b''
+            elif count <= fail_first:
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                body = b''
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                body = images[name]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.requests_count = requests_count
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/" % server.server_address[1]
+
+
+def random_jpeg(rng, size=(320, 240)):
+    buffer = BytesIO()
+    Image.fromarray(rng.randint(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def run(n_images=200, n_classes=10, missing=5, shard_size=64):
+    rng = np.random.RandomState(2002)
+    images = {"%d.jpg" % i: random_jpeg(rng) for i in range(n_images)}
+    missing = set("%d.jpg" % i for i in range(missing))
+    server, url = stand_in_server(images, fail_first=1, missing=missing)
+
+    root = tempfile.mkdtemp()
+    try:
+        source = os.path.join(root, 'index.csv')
+        target = os.path.join(root, 'shards')
+        pd.DataFrame({
+            'id': ["img%d" % i for i in range(n_images)],
+            'url': [url + "%d.jpg" % i for i in range(n_images)],
+            'landmark_id': [i % n_classes for i in range(n_images)],
+        }).to_csv(source, index=False)
+
+        # every image fails once with 503 and is retried
+        start_time = time.time()
+        stats = load_from_index(source, target, image_size=32, download_workers=8, decode_workers=2,
+                                host_rate=0, backoff=0.01, shard_size=shard_size)
+        print("First run: %s in %.2f s" % (stats, time.time() - start_time))
+        assert stats['done'] == n_images - len(missing) and stats['failed'] == len(missing)
+
+        # resumed from the manifest, nothing is downloaded again
+        requests_count = sum(server.requests_count.values())
+        stats = load_from_index(source, target, image_size=32, download_workers=8, decode_workers=2, host_rate=0)
+        print("Second run: %s" % stats)
+        assert stats['skipped'] == n_images and sum(server.requests_count.values()) == requests_count
+
+        manifest = Manifest(target)
+        manifest.close()
+        assert sum(manifest.done(image_id) for image_id in manifest.status) == n_images - len(missing)
+
+        dataset = GoogleLandmarksDatasetBase(target, reduce=0.0, random_seed=42)
+        image, label, _ = dataset[0]
+        print("Dataset: %d images, %d classes, image %s" % (len(dataset), dataset.CLASSES, tuple(image.shape)))
+        assert len(dataset) == n_images - len(missing) and dataset.CLASSES == n_classes
+        assert tuple(image.shape) == (3, 32, 32)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,37 @@
+import torch
+
+from models.images.classification.few_shot_learning.prototype_index import IVFPrototypeIndex, exact_search
+
+
+def check_search(index, embeddings, queries, k):
+    distances, indices = index.search(queries, k)
+    exact_distances, exact_indices = exact_search(embeddings, queries, k)
+    assert indices.shape == exact_indices.shape, (indices.shape, exact_indices.shape)
+    assert (indices >= 0).all() and torch.isfinite(distances).all()
+
+    probabilities, _ = index.search_proba(queries, k)
+    assert torch.isfinite(probabilities).all() and torch.allclose(probabilities.sum(dim=1), torch.ones(len(queries)))
+    return distances, indices, exact_distances, exact_indices
+
+
+def run(dim=16, n_queries=20):
+    # k larger than the number of stored prototypes: k is clamped as in exact_search
+    embeddings = torch.randn(5, dim)
+    queries = torch.randn(n_queries, dim)
+    index = IVFPrototypeIndex(n_lists=2, n_probe=2).build(embeddings)
+    _, indices, _, exact_indices = check_search(index, embeddings, queries, k=10)
+    assert torch.equal(indices.sort(dim=1).values, exact_indices.sort(dim=1).values)
+    print("k > classes: ok, %d of %d returned" % (indices.size(1), 10))
+
+    # one probed list of mostly single prototypes holds fewer than k candidates: exact fallback
+    embeddings = torch.randn(64, dim)
+    index = IVFPrototypeIndex(n_lists=32, n_probe=1).build(embeddings)
+    distances, indices, exact_distances, exact_indices = check_search(index, embeddings, queries, k=5)
+    assert torch.allclose(distances, exact_distances) and torch.equal(indices, exact_indices)
+    print("sparse lists: ok, %d lists, largest %d" % (index.centroids.size(0), int(index.list_sizes.max())))
+
+
+if __name__ == '__main__':
+    torch.random.manual_seed(2002)
+    with torch.no_grad():
+        run()
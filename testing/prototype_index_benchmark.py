@@ -0,0 +1,45 @@
+import time
+
+import torch
+
+from models.images.classification.few_shot_learning.prototype_index import IVFPrototypeIndex, exact_search
+from utils import pretty_time
+
+
+def clustered_embeddings(n_classes, dim, n_clusters, noise=0.5):
+    centers = torch.randn(n_clusters, dim)
+    return centers[torch.randint(n_clusters, (n_classes,))] + noise * torch.randn(n_classes, dim)
+
+
+def benchmark(n_classes=10000, dim=2304, n_queries=500, k=5, n_lists=None, n_probes=(1, 4, 8, 16, 32)):
+    embeddings = clustered_embeddings(n_classes, dim, n_clusters=n_classes // 10)
+    queries = embeddings[torch.randint(n_classes, (n_queries,))] + 0.3 * torch.randn(n_queries, dim)
+
+    start_time = time.time()
+    _, exact_indices = exact_search(embeddings, queries, k)
+    exact_time = time.time() - start_time
+    print("%d classes, %d queries, top-%d" % (n_classes, n_queries, k))
+    print("Exact search: %.3f ms per query" % (exact_time / n_queries * 1000))
+
+    start_time = time.time()
+    index = IVFPrototypeIndex(n_lists=n_lists).build(embeddings)
+    print("Index build time: %s (%d lists)" % (pretty_time(time.time() - start_time), index.centroids.size(0)))
+
+    for n_probe in n_probes:
+        index.n_probe = n_probe
+        start_time = time.time()
+        _, indices = index.search(queries, k)
+        search_time = time.time() - start_time
+
+        found = 0
+        for i in range(n_queries):
+            found += len(set(indices[i].tolist()) & set(exact_indices[i].tolist()))
+        recall = found / (n_queries * k)
+        print("n_probe = %d\trecall@%d = %.3f\t%.3f ms per query (x%.1f)" % (
+            n_probe, k, recall, search_time / n_queries * 1000, exact_time / search_time))
+
+
+if __name__ == '__main__':
+    torch.random.manual_seed(2002)
+    with torch.no_grad():
+        benchmark()
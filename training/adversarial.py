@@ -1,16 +1,18 @@
+import os
 import time
 
-import numpy as np
 import torch
 import torchvision.utils as vutils
+from PIL import Image
 from torch import nn
 from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader
 
 from sessions import Session
 from training import pretty_time
-from visualization.image import ImageWindow
-from visualization.plots import PlotterWindow
+from visualization import metrics
+from visualization.image import SharedImageWindow
+from visualization.metrics import MetricsSink
 
 
 def noisy_tensor(label, size, noise, min_value=None, max_value=None):
@@ -35,15 +37,26 @@ def train(session: Session,
           progress_tracker_size=4,
           verbosity_period=50,
           progress_save_period=None,
+          preview_period=50,
+          preview_interval=None,
+          live_preview=None,
+          progress_dir=None,
           ):
+    # The preview grid of fixed_noise is generated every preview_period iterations and/or preview_interval seconds
+    # and at every progress save point. Progress grids are saved as a PNG sequence to progress_dir.
     if progress_save_period is None:
         progress_save_period = len(dataloader) // 5
+    if progress_dir is None:
+        progress_dir = os.path.join(session.data['output_dir'], 'progress')
+    os.makedirs(progress_dir, exist_ok=True)
+    if live_preview is None:
+        live_preview = metrics.LIVE_PLOTS
     generator = generator.to(device)
     discriminator = discriminator.to(device)
     loss = loss.to(device)
 
-    plotter = PlotterWindow(interval=1000)
-    image_window = ImageWindow(interval=1000)
+    plotter = MetricsSink('loss')
+    image_window = None
 
     it_per_epoch = len(dataloader)
 
@@ -64,6 +77,7 @@ def train(session: Session,
     plotter.new_line('d_losses')
     d_losses = []
     g_progress_list = []
+    last_preview_time = time.time()
     for epoch in range(cur_epoch, epochs):
         for epoch_it, data in enumerate(dataloader, 0):
             cur_batch_size = data.size(0)
@@ -111,10 +125,25 @@ def train(session: Session,
             plotter.add_point('d_losses', cur_it, loss_d.item())
             d_losses.append(loss_d.item())
 
-            with torch.no_grad():
-                cur_fake = generator(fixed_noise).detach().cpu()
-            cur_generated = vutils.make_grid(cur_fake, padding=2, normalize=True, nrow=progress_tracker_size)
-            image_window.set_image(np.transpose(cur_generated, (1, 2, 0)))
+            save_progress = epoch_it % progress_save_period == 0 or epoch_it == len(dataloader) - 1
+            preview = save_progress or (preview_period is not None and cur_it % preview_period == 0) or (
+                    preview_interval is not None and cur_time - last_preview_time >= preview_interval)
+
+            if preview and (live_preview or save_progress):
+                last_preview_time = cur_time
+                with torch.no_grad():
+                    cur_fake = generator(fixed_noise).detach().cpu()
+                cur_generated = vutils.make_grid(cur_fake, padding=2, normalize=True, nrow=progress_tracker_size)
+                cur_generated = cur_generated.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).permute(1, 2, 0).numpy()
+
+                if live_preview:
+                    if image_window is None:
+                        image_window = SharedImageWindow(cur_generated.shape, interval=1000)
+                    image_window.set_image(cur_generated)
+                if save_progress:
+                    progress_file = os.path.join(progress_dir, "%08d.png" % cur_it)
+                    Image.fromarray(cur_generated).save(progress_file)
+                    g_progress_list.append(progress_file)
 
             if epoch_it % verbosity_period == 0 or epoch_it == len(dataloader) - 1:
                 print('[%d/%d][%d/%d] = %.2f%%\t\tLoss_G: %.4f\tLoss_D: %.4f\tD(y): %.4f\tD(G(x)): %.4f' %
@@ -126,11 +155,13 @@ def train(session: Session,
                     pretty_time(time_per_it * (it_per_epoch * epochs - cur_it)),
                 ))
                 print()
-            if epoch_it % progress_save_period == 0 or epoch_it == len(dataloader) - 1:
-                g_progress_list.append(cur_generated)
 
         session.checkpoint()
 
+    plotter.close()
+    if image_window is not None:
+        image_window.stop()
+
     cur_time = time.time()
     delta_time = cur_time - start_time
     session.info['status'] = "Finished"
@@ -7,13 +7,13 @@ from torch.utils.data import DataLoader
 from torch.utils.data.dataset import Dataset
 from torchvision import models
 
-from data import LABELED_DATASETS, LabeledSubdataset
+from data import LABELED_DATASETS, LabeledSubdataset, prepare_batch
 from history.index import save_record
 from models.images.classification.backbones import ResNet18NoFlattening
 from models.images.classification.meta_learning_few_shot import MODELS, FewShotLearningTask, BaselineClassifier, \
     SupportSetMeanFeaturesModel
 from training import pretty_time
-from visualization.plots import PlotterWindow
+from visualization.metrics import MetricsSink
 
 
 def accuracy(labels, labels_pred):
@@ -61,6 +61,7 @@ class EpisodeSampler(Dataset):
         support_set_labels = support_subdataset.labels()
 
         support_set = [[] for i in range(len(support_set_labels))]
+        support_is_test = [[] for i in range(len(support_set_labels))]
 
         h = 0
         for label in support_set_labels:
@@ -68,8 +69,13 @@ class EpisodeSampler(Dataset):
             h += 1
 
         for i in range(len(support_subdataset)):
-            item, label, _ = support_subdataset[i]
+            item, label, is_test = support_subdataset[i]
             support_set[classes_mapping[label]].append(item.to(self.device))
+            support_is_test[classes_mapping[label]].append(is_test)
+        for i in range(len(support_set)):
+            support_set[i] = torch.stack(support_set[i])
+        # one normalization for the whole support set, (n_way, n_shot, 3, h, w)
+        support_set = self.subdataset.prepare_batch(torch.stack(support_set), support_is_test)
 
         batch = cur_subdataset.random_batch(self.batch_size)
         for i in range(len(batch[1])):
@@ -116,8 +122,8 @@ def meta_learning_train(model: SupportSetMeanFeaturesModel, optimizer, base_subd
     base_sampler = EpisodeSampler(subdataset=base_subdataset, n_way=n_way, n_shot=n_shot, batch_size=batch_size)
     val_sampler = EpisodeSampler(subdataset=val_subdataset, n_way=n_way, n_shot=n_shot, batch_size=batch_size)
 
-    loss_plotter = PlotterWindow(interval=1000)
-    accuracy_plotter = PlotterWindow(interval=1000)
+    loss_plotter = MetricsSink('loss')
+    accuracy_plotter = MetricsSink('accuracy')
 
     loss_plotter.new_line('Loss')
     accuracy_plotter.new_line('Train Accuracy')
@@ -176,6 +182,9 @@ def meta_learning_train(model: SupportSetMeanFeaturesModel, optimizer, base_subd
             ))
             print()
 
+    loss_plotter.close()
+    accuracy_plotter.close()
+
     cur_time = time.time()
     training_time = cur_time - start_time
     print("Training finished. Total execution time: %s" % pretty_time(training_time))
@@ -194,8 +203,8 @@ def baseline_train(model: BaselineClassifier, optimizer, base_subdataset: Labele
     dataloader = DataLoader(dataset=base_subdataset, batch_size=train_batch_size, shuffle=True, num_workers=4)
     val_sampler = EpisodeSampler(subdataset=val_subdataset, n_way=n_way, n_shot=n_shot, batch_size=batch_size)
 
-    loss_plotter = PlotterWindow(interval=1000)
-    accuracy_plotter = PlotterWindow(interval=1000)
+    loss_plotter = MetricsSink('loss')
+    accuracy_plotter = MetricsSink('accuracy')
 
     loss_plotter.new_line('Loss')
     accuracy_plotter.new_line('Train Accuracy')
@@ -223,8 +232,8 @@ def baseline_train(model: BaselineClassifier, optimizer, base_subdataset: Labele
         cur_loss = 0
 
         for batch_num, data in enumerate(dataloader):
-            x, y, _ = data
-            x = x.to(device)
+            x, y, is_test = data
+            x = prepare_batch(base_subdataset, x.to(device), is_test)
             y = y.to(device)
 
             optimizer.zero_grad()
@@ -273,6 +282,9 @@ def baseline_train(model: BaselineClassifier, optimizer, base_subdataset: Labele
             ))
             print()
 
+    loss_plotter.close()
+    accuracy_plotter.close()
+
     cur_time = time.time()
     training_time = cur_time - start_time
     print("Training finished. Total execution time: %s" % pretty_time(training_time))
@@ -7,9 +7,10 @@ from torch import nn
 from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader
 
+from data import prepare_batch
 from sessions import Session
 from training import pretty_time
-from visualization.plots import PlotterWindow
+from visualization.metrics import MetricsSink
 
 
 def accuracy(labels, labels_pred):
@@ -29,8 +30,8 @@ def eval_model(model: nn.Module, dataloader: DataLoader, loss: nn.Module, device
         eval_loss = 0
 
         for data in dataloader:
-            x, labels, _ = data
-            x = x.to(device)
+            x, labels, is_test = data
+            x = prepare_batch(dataloader.dataset, x.to(device), is_test)
             labels = labels.to(device).long()
 
             y_pred = model(x)
@@ -62,8 +63,8 @@ def train_classifier(session: Session,
     model = model.to(device)
     loss = loss.to(device)
 
-    loss_plotter = PlotterWindow(interval=1000)
-    eval_plotter = PlotterWindow(interval=1000)
+    loss_plotter = MetricsSink('loss')
+    eval_plotter = MetricsSink('eval')
 
     it_per_epoch = len(dataloader)
 
@@ -73,6 +74,7 @@ def train_classifier(session: Session,
     start_time = time.time()
 
     cur_it = it_per_epoch * cur_epoch
+    start_it = cur_it
     total_it = it_per_epoch * epochs
 
     loss_plotter.new_line('Loss')
@@ -88,19 +90,29 @@ def train_classifier(session: Session,
 
     eval_iters = [0]
 
-    val_loss, acc, ba_score = eval_model(model, val_dataloader, loss, device)
-    val_losses.append(val_loss)
-    loss_plotter.add_point("Val Loss", cur_it, val_loss)
-    acc_scores.append(acc)
-    eval_plotter.add_point('Accuracy', cur_it, acc)
-    ba_scores.append(ba_score)
-    eval_plotter.add_point('Balanced Accuracy', cur_it, ba_score)
+    metrics = getattr(session, 'metrics', None)
+    if cur_epoch > 0 and metrics is not None:
+        # resumed session: metric history is restored from the checkpoint, the initial evaluation is skipped
+        # to keep the random number sequence of the interrupted run
+        losses = metrics['losses']
+        val_losses = metrics['val_losses']
+        eval_iters = metrics['eval_iters']
+        acc_scores = metrics['acc_scores']
+        ba_scores = metrics['ba_scores']
+    else:
+        val_loss, acc, ba_score = eval_model(model, val_dataloader, loss, device)
+        val_losses.append(val_loss)
+        loss_plotter.add_point("Val Loss", cur_it, val_loss)
+        acc_scores.append(acc)
+        eval_plotter.add_point('Accuracy', cur_it, acc)
+        ba_scores.append(ba_score)
+        eval_plotter.add_point('Balanced Accuracy', cur_it, ba_score)
 
     for epoch in range(cur_epoch, epochs):
         model.train()
         for epoch_it, data in enumerate(dataloader, 0):
-            x, y, _ = data
-            x = x.to(device)
+            x, y, is_test = data
+            x = prepare_batch(dataloader.dataset, x.to(device), is_test)
             y = y.to(device).long()
 
             optimizer.zero_grad()
@@ -114,7 +126,7 @@ def train_classifier(session: Session,
 
             cur_time = time.time()
             delta_time = cur_time - start_time
-            time_per_it = delta_time / cur_it
+            time_per_it = delta_time / (cur_it - start_it)
 
             loss_plotter.add_point('Loss', cur_it, model_loss.item())
             losses.append(model_loss.item())
@@ -150,8 +162,19 @@ def train_classifier(session: Session,
             print('Validation time: %s' % (pretty_time(val_time),))
             print()
 
+            session.data['cur_epoch'] = epoch + 1
+            session.metrics = {
+                'losses': losses,
+                'val_losses': val_losses,
+                'eval_iters': eval_iters,
+                'acc_scores': acc_scores,
+                'ba_scores': ba_scores,
+            }
             session.checkpoint()
 
+    loss_plotter.close()
+    eval_plotter.close()
+
     session.info['test_accuracy'] = acc_scores[-1]
     session.info['test_balanced_accuracy'] = ba_scores[-1]
 
@@ -1,3 +1,8 @@
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
 from visualization import Processor, WindowController
 
 
@@ -44,3 +49,54 @@ class ImageWindow(WindowController):
             return self.broken_pipe_message()
 
         return True
+
+
+class ProcessSharedImage(ProcessImage):
+    def __init__(self, shape, shm_name, version, interval=1000):
+        super().__init__(interval=interval)
+        self.shape = shape
+        self.shm_name = shm_name
+        self.version = version
+        self.shown_version = 0
+        self.shm = None
+        self.buffer = None
+
+    def call_back(self):
+        while self.pipe.poll():
+            if self.pipe.recv() is None:
+                self.terminate()
+                return False
+        if self.buffer is None:
+            self.shm = SharedMemory(name=self.shm_name)
+            self.buffer = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        if self.version.value != self.shown_version:
+            self.shown_version = self.version.value
+            self.set_image(self.buffer.copy())
+            self.draw_all()
+        return True
+
+
+class SharedImageWindow(WindowController):
+    # The image is written to a shared memory buffer, the viewer redraws when the version counter changes;
+    # nothing is pickled per image
+
+    def __init__(self, shape, interval=1000):
+        self.shape = tuple(shape)
+        self.shm = SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.buffer = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.version = mp.Value('i', 0, lock=False)
+        super().__init__(ProcessSharedImage(self.shape, self.shm.name, self.version, interval=interval))
+
+    def set_image(self, image):
+        # uint8 (height, width, 3)
+        self.buffer[...] = image
+        self.version.value += 1
+        return True
+
+    def stop(self):
+        try:
+            super().stop()
+        except BrokenPipeError:
+            pass
+        self.shm.close()
+        self.shm.unlink()
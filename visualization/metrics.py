@@ -0,0 +1,185 @@
+import argparse
+import atexit
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from visualization import Processor, WindowController
+
+# Directory of the metrics logs, the METRICS_DIR environment variable overrides it
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(os.path.expanduser('~'), 'torch-nn-metrics')
+# Start a live viewer process for every sink, the log is written either way
+LIVE_PLOTS = False
+
+FLUSH_POINTS = 1000
+FLUSH_INTERVAL = 5.0
+VIEWER_MAX_POINTS = 2000
+
+
+def metrics_path(name, directory=None):
+    directory = METRICS_DIR if directory is None else directory
+    return os.path.join(directory, "%s_%s.jsonl" % (name, datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")))
+
+
+class MetricsSink(object):
+    # Drop-in replacement of PlotterWindow: points are buffered and appended to a JSONL event log in batches,
+    # one record per line and flush: {"line": name, "x": [...], "y": [...]}.
+    # directory: e.g. the output_dir of a session, METRICS_DIR by default
+
+    def __init__(self, name='metrics', path=None, directory=None, live=None, flush_points=FLUSH_POINTS,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = metrics_path(name, directory) if path is None else path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.flush_points = flush_points
+        self.flush_interval = flush_interval
+
+        self.records = []
+        self.buffer = {}
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+        self.viewer = None
+        if LIVE_PLOTS if live is None else live:
+            open(self.path, 'a').close()
+            self.viewer = MetricsViewerWindow(self.path)
+        atexit.register(self.flush)
+
+    def new_line(self, name, style=None):
+        self.records.append({'line': str(name), 'style': style})
+        self.buffer.setdefault(str(name), ([], []))
+        return True
+
+    def add_point(self, line_name, x, y):
+        xs, ys = self.buffer.setdefault(str(line_name), ([], []))
+        xs.append(x)
+        ys.append(float(y))
+        self.n_buffered += 1
+        if self.n_buffered >= self.flush_points or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return True
+
+    def flush(self):
+        records = self.records
+        for line_name, (xs, ys) in self.buffer.items():
+            if xs:
+                records.append({'line': line_name, 'x': xs, 'y': ys})
+                self.buffer[line_name] = ([], [])
+        if records:
+            with open(self.path, 'a') as fout:
+                fout.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.records = []
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        if self.viewer is not None:
+            try:
+                self.viewer.stop()
+            except BrokenPipeError:
+                pass
+
+
+class MetricsLogReader(object):
+    # Incremental reader of a MetricsSink log: every read() parses only the records appended since the last one
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.styles = {}
+        self.chunks = {}
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, 'rb') as fin:
+            fin.seek(self.offset)
+            for line in fin:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                record = json.loads(line)
+                chunks = self.chunks.setdefault(record['line'], [])
+                if 'style' in record:
+                    self.styles[record['line']] = record['style']
+                else:
+                    chunks.append((np.asarray(record['x'], dtype=np.float64),
+                                   np.asarray(record['y'], dtype=np.float64)))
+        for line_name, chunks in self.chunks.items():
+            if len(chunks) > 1:
+                self.chunks[line_name] = [(np.concatenate([x for x, _ in chunks]),
+                                           np.concatenate([y for _, y in chunks]))]
+        return self
+
+    def lines(self, max_points=None):
+        result = {}
+        for line_name, chunks in self.chunks.items():
+            x, y = chunks[0] if chunks else (np.empty(0), np.empty(0))
+            if max_points is not None:
+                x, y = downsample(x, max_points), downsample(y, max_points)
+            result[line_name] = x, y
+        return result
+
+
+def downsample(values, max_points):
+    # mean of consecutive buckets, the last bucket may be shorter
+    if len(values) <= max_points:
+        return values
+    bucket = -(-len(values) // max_points)
+    full = len(values) // bucket * bucket
+    result = values[:full].reshape(-1, bucket).mean(axis=1)
+    if full < len(values):
+        result = np.append(result, values[full:].mean())
+    return result
+
+
+def read_metrics(path, max_points=None):
+    return MetricsLogReader(path).read().lines(max_points)
+
+
+class ProcessMetricsViewer(Processor):
+    def __init__(self, path, interval=1000, max_points=VIEWER_MAX_POINTS):
+        self.reader = MetricsLogReader(path)
+        self.interval = interval
+        self.max_points = max_points
+
+    def call_back(self):
+        if self.pipe is not None and self.pipe.poll() and self.pipe.recv() is None:
+            self.terminate()
+            return False
+
+        self.clear()
+        for line_name, (x, y) in self.reader.read().lines(self.max_points).items():
+            style = self.reader.styles.get(line_name)
+            if style is None:
+                self.ax.plot(x, y, label=line_name)
+            else:
+                self.ax.plot(x, y, style, label=line_name)
+        if self.reader.chunks:
+            self.ax.legend()
+        self.flush()
+        return True
+
+
+class MetricsViewerWindow(WindowController):
+    def __init__(self, path, interval=1000, max_points=VIEWER_MAX_POINTS):
+        super().__init__(ProcessMetricsViewer(path, interval=interval, max_points=max_points))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Live plot of a metrics log.')
+
+    parser.add_argument('path', type=str, help='Path to metrics log written by MetricsSink')
+    parser.add_argument('--interval', type=int, default=1000, help='Refresh interval in milliseconds')
+    parser.add_argument('--max_points', type=int, default=VIEWER_MAX_POINTS)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    ProcessMetricsViewer(args.path, interval=args.interval, max_points=args.max_points)(None)